@@ -0,0 +1,168 @@
+'''Encodings of the AD9914 Pico command table used for upload over serial.
+
+These only depend on numpy, so they can be shared between labscript (compile time)
+and BLACS (upload time).'''
+import zlib
+
+import numpy as np
+
+# Columns of the dds_data table written to the shot file, one row per command
+dds_data_dtype = [('start freq', float),
+                  ('start amp', float),
+                  ('stop freq', float),
+                  ('stop amp', float),
+                  ('sweep', bool),
+                  ('sweep time', float),
+                  ('trigger', bool)]
+
+# Packed little-endian record for binary uploads, one per dds_data row.
+# Amplitudes are only 12 bit in hardware, so single precision is plenty.
+binary_record_dtype = np.dtype([('start freq', '<f8'),
+                                ('stop freq', '<f8'),
+                                ('start amp', '<f4'),
+                                ('stop amp', '<f4'),
+                                ('sweep time', '<f8'),
+                                ('flags', 'u1')])
+
+# Integer columns added to dds_data by quantize, in the AD9914's native units:
+# 32 bit frequency tuning words, 12 bit amplitude scale factors,
+# and sweep durations in SYNC_CLK periods (24 system clock cycles).
+quantized_columns = [('start ftw', '<u4'),
+                     ('stop ftw', '<u4'),
+                     ('start asf', '<u2'),
+                     ('stop asf', '<u2'),
+                     ('sweep ticks', '<u4')]
+
+# Packed record for binary uploads of the quantized columns
+integer_record_dtype = np.dtype(quantized_columns + [('flags', 'u1')])
+
+FLAG_SWEEP = 0x1
+FLAG_TRIGGER = 0x2
+
+binary_terminator = b'end\n'
+
+def binary_header(count):
+    '''Header line for an 'addb' upload of count records.
+    The firmware reads exactly count * record size bytes after the newline,
+    then expects binary_terminator.'''
+    return 'addb:{:d},{:d}\n'.format(count, binary_record_dtype.itemsize).encode()
+
+def integer_header(count):
+    '''Header line for an 'addi' upload of count integer records.'''
+    return 'addi:{:d},{:d}\n'.format(count, integer_record_dtype.itemsize).encode()
+
+def _flags(commands):
+    return (np.where(commands['sweep'], FLAG_SWEEP, 0)
+            | np.where(commands['trigger'], FLAG_TRIGGER, 0))
+
+def binary_records(commands):
+    '''Returns a dds_data structured array as an array of binary records.'''
+    records = np.empty(len(commands), dtype=binary_record_dtype)
+    for name in ['start freq', 'stop freq', 'start amp', 'stop amp', 'sweep time']:
+        records[name] = commands[name]
+    records['flags'] = _flags(commands)
+    return records
+
+def integer_records(commands):
+    '''Returns the quantized columns of a dds_data structured array as integer records.'''
+    records = np.empty(len(commands), dtype=integer_record_dtype)
+    for name, _ in quantized_columns:
+        records[name] = commands[name]
+    records['flags'] = _flags(commands)
+    return records
+
+def text_records(commands):
+    '''Returns the binary records the firmware builds from 'add' text commands,
+    whose values are rounded by the '{:e}' format. Constant rows are stored
+    with stop values equal to the start values and no sweep time.'''
+    records = binary_records(commands)
+    for name in ['start freq', 'stop freq', 'start amp', 'stop amp', 'sweep time']:
+        records[name] = np.char.mod('%e', commands[name]).astype(np.float64)
+    constant = records['flags'] & FLAG_SWEEP == 0
+    records['stop freq'][constant] = records['start freq'][constant]
+    records['stop amp'][constant] = records['start amp'][constant]
+    records['sweep time'][constant] = 0
+    return records
+
+def encode_binary(commands):
+    '''Pack a dds_data structured array into binary records, returned as bytes.'''
+    return binary_records(commands).tobytes()
+
+def encode_integer(commands):
+    '''Pack the quantized columns of a dds_data structured array into integer records.'''
+    return integer_records(commands).tobytes()
+
+# Payloads precomputed at compile time are stored with a 'protocol' attribute naming
+# their encoding, mapped here to the firmware capability needed to send them.
+# Bump the version whenever an encoding changes, so old shot files fall back to dds_data.
+payload_protocols = {'addb/1': 'bin', 'addi/1': 'int'}
+
+def encode_payload(commands, integer=False):
+    '''Encodes a dds_data structured array as the exact bytes of a binary upload
+    (header line, records and terminator), so it can be sent in a single write.
+    If integer, the quantized columns are sent as integer records.
+    Returns (protocol, payload), with the payload as a uint8 array.'''
+    if integer:
+        protocol = 'addi/1'
+        header = integer_header(len(commands))
+        records = integer_records(commands)
+    else:
+        protocol = 'addb/1'
+        header = binary_header(len(commands))
+        records = binary_records(commands)
+    payload = np.frombuffer(header + records.tobytes() + binary_terminator, dtype=np.uint8)
+    return protocol, payload
+
+def payload_records(payload, protocol):
+    '''Returns the records held in a payload made by encode_payload.'''
+    payload = np.asarray(payload, dtype=np.uint8)
+    start = np.flatnonzero(payload == ord('\n'))[0] + 1
+    dtype = integer_record_dtype if protocol.startswith('addi/') else binary_record_dtype
+    return payload[start:len(payload) - len(binary_terminator)].view(dtype)
+
+def payload_count(payload, protocol):
+    '''Returns the number of records held in a payload made by encode_payload
+    (an array or h5py dataset), reading only its header line.'''
+    header = np.asarray(payload[:64], dtype=np.uint8)
+    start = np.flatnonzero(header == ord('\n'))[0] + 1
+    dtype = integer_record_dtype if protocol.startswith('addi/') else binary_record_dtype
+    return (len(payload) - start - len(binary_terminator)) // dtype.itemsize
+
+def checksum(records):
+    '''CRC32 of an array of records, as reported by the firmware's 'crc' command.'''
+    return zlib.crc32(records.tobytes()) & 0xffffffff
+
+def parse_dump(resp, dtype):
+    '''Parses the reply to 'dmp', one comma separated record per line,
+    into an array of records of the given dtype.'''
+    rows = []
+    for line in resp.decode(errors='replace').splitlines():
+        if ',' in line:
+            rows.append(tuple(float(value) for value in line.split(',')))
+    return np.array(rows, dtype=dtype)
+
+def diff_records(expected, actual):
+    '''Returns the indices of rows which differ between two arrays of records,
+    including any rows present in only one of them.'''
+    n = min(len(expected), len(actual))
+    differ = np.zeros(n, dtype=bool)
+    for name in expected.dtype.names:
+        differ |= expected[name][:n] != actual[name][:n]
+    return np.concatenate([np.flatnonzero(differ),
+                           np.arange(n, max(len(expected), len(actual)))])
+
+max_sweep_ticks = np.iinfo(np.uint32).max # Longest sweep an integer record can hold
+
+def quantize(commands, sysclk):
+    '''Returns a copy of a dds_data structured array with quantized_columns added,
+    for an AD9914 running from a system clock of sysclk Hz.'''
+    quantized = np.empty(len(commands), dtype=commands.dtype.descr + quantized_columns)
+    for name in commands.dtype.names:
+        quantized[name] = commands[name]
+    quantized['start ftw'] = np.round(commands['start freq'] * (2**32 / sysclk))
+    quantized['stop ftw'] = np.round(commands['stop freq'] * (2**32 / sysclk))
+    quantized['start asf'] = np.round(commands['start amp'] * 4095)
+    quantized['stop asf'] = np.round(commands['stop amp'] * 4095)
+    quantized['sweep ticks'] = np.where(commands['sweep'],
+                                        np.round(commands['sweep time'] * sysclk / 24), 0)
+    return quantized
@@ -1,21 +1,43 @@
 from blacs.tab_base_classes import Worker
 import labscript_utils.h5_lock, h5py
+import numpy as np
+
+import threading
+from time import sleep
+from timeit import default_timer as timer
+
+from user_devices.AD9914_pico import ad9914_protocol
+from user_devices import pico_protocol, pico_upload
 
 class AD9914PicoInterface(object):
-    def __init__(self, com_port):
+    def __init__(self, com_port, binary=True, window=16):
         global serial; import serial
 
         self.timeout = 0.1
+        self.window = window # Maximum number of 'add' commands awaiting a prompt
+        self.upload_stats = None
+        self.dump_timeout = 5 # Dumps of long tables take a while to read back
+        # Records uploaded since the last clear, for verify, or None if unknown
+        self.uploaded = []
         self.conn = serial.Serial(com_port, 10000000, timeout=self.timeout)
+        # Held by anything talking to the Pico from outside the worker thread (i.e. streaming)
+        self.lock = threading.Lock()
 
         self.clear()
         if not self.clear():
             raise RuntimeError('Unable to communicate with AD9914 Pico')
 
+        self.capabilities = pico_protocol.get_capabilities(self.conn)
+        # Use binary uploads if requested and the firmware supports them
+        self.binary = binary and 'bin' in self.capabilities
+        # The uploaded records are only needed to verify the table
+        self.keep_uploaded = 'crc' in self.capabilities
+
     def clear(self):
         '''Sends 'cls' command, which clears the currently stored run.
         Returns response, throws serial exception on disconnect.'''
         self.conn.write(b'cls\n')
+        self.uploaded = []
         return self.conn.read_until(b'> ')
 
     def abort(self):
@@ -30,6 +52,30 @@ class AD9914PicoInterface(object):
         self.conn.write(b'run\n')
         return self.conn.read_until(b'> ')
 
+    def free(self):
+        '''Sends 'fre' command, which reports how many more entries the table can take.
+        During a streamed run, entries which have been played are freed again.
+        Returns the number of free entries.'''
+        value = pico_protocol.query(self.conn, b'fre')
+        if value is None:
+            raise RuntimeError('AD9914 Pico did not report its free table space')
+        return int(value)
+
+    def stream(self):
+        '''Sends 'str' command, which makes the next run wait for more entries
+        when it reaches the end of the table, until finish is sent.
+        Played entries are freed, so the streamed records are not kept for verify.
+        Returns response, throws serial exception on disconnect.'''
+        self.uploaded = None
+        self.conn.write(b'str\n')
+        return self.conn.read_until(b'> ')
+
+    def finish(self):
+        '''Sends 'fin' command, which marks the end of a streamed run.
+        Returns response, throws serial exception on disconnect.'''
+        self.conn.write(b'fin\n')
+        return self.conn.read_until(b'> ')
+
     def dump(self):
         '''Sends 'dmp' command, which dumps the currently loaded run.
         Returns the dump of the run.'''
@@ -39,104 +85,346 @@ class AD9914PicoInterface(object):
     def add(self, start_freq, start_amp, stop_freq=None, stop_amp=None, sweep_time=None, trigger=True):
         '''Sends 'add' command with the given parameters
         Returns response, throws serial exception on disconnect.'''
+        self.conn.write(self._format_add(start_freq, start_amp, stop_freq, stop_amp,
+                                         sweep_time, trigger))
+        self.uploaded = None
+        return self.conn.read_until(b'> ')
+
+    def set_output(self, freq, amp):
+        '''Sends 'set' command, which immediately outputs a constant frequency and amplitude
+        and leaves it as the only entry of the stored run, as abort, clear,
+        an untriggered add and run would, but in a single round trip.
+        Returns response, throws RuntimeError if the Pico rejects it or does not reply.'''
+        self.conn.write('set:{:e},{:e}\n'.format(freq, amp).encode())
+        resp = self.conn.read_until(b'> ')
+        if pico_protocol.is_error(resp) or not resp.endswith(b'> '):
+            raise RuntimeError('AD9914 Pico did not set its output: {}'
+                               .format(resp.decode(errors='replace').strip()))
+        self.uploaded = None
+        return resp
+
+    def _format_add(self, start_freq, start_amp, stop_freq, stop_amp, sweep_time, trigger):
+        '''Returns the 'add' command line for the given parameters.'''
         if trigger:
             trigger = 1
         else:
             trigger = 0
         if stop_freq is None and stop_amp is None:
-            self.conn.write('add:cst,{:e},cst,{:e},{:e}\n'
-                            .format(start_freq, start_amp, trigger).encode())
+            return ('add:cst,{:e},cst,{:e},{:e}\n'
+                    .format(start_freq, start_amp, trigger).encode())
         elif sweep_time is None:
             raise RuntimeError('Error AD9914 Pico attempting to sweep with no sweep time')
         elif stop_amp is None:
-            self.conn.write('add:lin,{:e},{:e},cst,{:e},{:e},{:e}\n'
-                            .format(start_freq, stop_freq, start_amp, sweep_time, trigger)
-                            .encode())
+            return ('add:lin,{:e},{:e},cst,{:e},{:e},{:e}\n'
+                    .format(start_freq, stop_freq, start_amp, sweep_time, trigger).encode())
         elif stop_freq is None:
-            self.conn.write('add:cst,{:e},lin,{:e},{:e},{:e},{:e}\n'
-                            .format(start_freq, start_amp, stop_amp, sweep_time, trigger)
-                            .encode())
+            return ('add:cst,{:e},lin,{:e},{:e},{:e},{:e}\n'
+                    .format(start_freq, start_amp, stop_amp, sweep_time, trigger).encode())
         else:
-            self.conn.write('add:lin,{:e},{:e},lin,{:e},{:e},{:e},{:e}\n'
-                            .format(start_freq, stop_freq, start_amp, stop_amp, sweep_time, trigger)
-                            .encode())
-        return self.conn.read_until(b'> ')
+            return ('add:lin,{:e},{:e},lin,{:e},{:e},{:e},{:e}\n'
+                    .format(start_freq, stop_freq, start_amp, stop_amp, sweep_time, trigger)
+                    .encode())
 
     def add_batch(self, commands):
-        '''Sends 'add' commands for each command in commands list. Returns response.'''
+        '''Sends 'add' commands for each command in commands list. Returns response.
+        If commands is a dds_data structured array (or h5py dataset) and the firmware
+        supports it, the whole table is sent as packed binary records instead.
+        Statistics for the upload are stored in self.upload_stats.'''
+        if self.binary and hasattr(commands, 'dtype'):
+            return self.add_binary(commands)
+        if isinstance(commands, h5py.Dataset):
+            commands = commands[()]
+        if self._keep_uploaded() and isinstance(commands, np.ndarray):
+            records = ad9914_protocol.text_records(commands)
+        else:
+            records = None
+        lines = []
         for command in commands:
-            trigger = command['trigger']
-            start_freq = command['start freq']
-            start_amp = command['start amp']
-            stop_freq = command['stop freq']
-            stop_amp = command['stop amp']
-            sweep_time = command['sweep time']
-            if trigger:
-                trigger = 1
-            else:
-                trigger = 0
-            if not command['sweep'] or (stop_freq is None and stop_amp is None):
-                self.conn.write('add:cst,{:e},cst,{:e},{:e}\n'
-                                .format(start_freq, start_amp, trigger).encode())
-            elif sweep_time is None:
-                raise RuntimeError('Error AD9914 Pico attempting to sweep with no sweep time')
-            elif stop_amp is None:
-                self.conn.write('add:lin,{:e},{:e},cst,{:e},{:e},{:e}\n'
-                                .format(start_freq, stop_freq, start_amp, sweep_time, trigger)
-                                .encode())
-            elif stop_freq is None:
-                self.conn.write('add:cst,{:e},lin,{:e},{:e},{:e},{:e}\n'
-                                .format(start_freq, start_amp, stop_amp, sweep_time, trigger)
-                                .encode())
+            if not command['sweep']:
+                lines.append(self._format_add(command['start freq'], command['start amp'],
+                                              None, None, None, command['trigger']))
             else:
-                self.conn.write('add:lin,{:e},{:e},lin,{:e},{:e},{:e},{:e}\n'
-                                .format(start_freq, stop_freq, start_amp, stop_amp, sweep_time, trigger)
-                                .encode())
-        resp = b''
-        for command in commands:
-            resp += self.conn.read_until(b'> ')
+                lines.append(self._format_add(command['start freq'], command['start amp'],
+                                              command['stop freq'], command['stop amp'],
+                                              command['sweep time'], command['trigger']))
+        resp = self._send_pipelined(lines)
+        if records is None:
+            self.uploaded = None
+        else:
+            self.uploaded.append(records)
+        return resp
+
+    def _send_pipelined(self, lines):
+        '''Sends command lines keeping at most self.window of them awaiting a prompt.
+        Replies are checked as they arrive, and sending stops at the first error.
+        Returns response, throws RuntimeError on an error reply or timeout.'''
+        t_start = timer()
+        resp = bytearray()
+        n_sent = 0
+        n_done = 0
+        scan = 0 # Start of the first reply which has not been checked yet
+        while n_done < len(lines):
+            if n_sent - n_done < self.window and n_sent < len(lines):
+                n_next = min(n_done + self.window, len(lines))
+                self.conn.write(b''.join(lines[n_sent:n_next]))
+                n_sent = n_next
+
+            data = self.conn.read(max(1, self.conn.in_waiting))
+            if not data:
+                raise RuntimeError('AD9914 Pico timed out after {:d} of {:d} commands'
+                                   .format(n_done, len(lines)))
+            resp += data
+
+            prompt = resp.find(b'> ', scan)
+            while prompt >= 0:
+                reply = bytes(resp[scan:prompt])
+                if pico_protocol.is_error(reply):
+                    # Wait for the commands already sent, so the port is left idle
+                    for _ in range(n_sent - n_done - 1 - resp.count(b'> ', prompt + 2)):
+                        self.conn.read_until(b'> ')
+                    raise RuntimeError('AD9914 Pico rejected command {:d} ({}): {}'
+                                       .format(n_done, lines[n_done].decode().strip(),
+                                               reply.decode(errors='replace').strip()))
+                n_done += 1
+                scan = prompt + 2
+                prompt = resp.find(b'> ', scan)
+
+        self._record_upload(len(lines), sum(len(line) for line in lines), t_start)
+        return bytes(resp)
+
+    def _record_upload(self, count, n_bytes, t_start):
+        duration = timer() - t_start
+        self.upload_stats = {'commands': count, 'bytes': n_bytes, 'time': duration,
+                             'commands_per_s': count / duration if duration > 0 else float('inf')}
+
+    def add_binary(self, commands):
+        '''Sends 'addb' command with a dds_data structured array (or h5py dataset)
+        packed as binary records. If the table was quantized at compile time
+        and the firmware supports it, sends 'addi' with the integer tuning words instead.
+        The records are encoded a chunk at a time, overlapping with the writes (see pico_upload).
+        Returns response, throws RuntimeError if the Pico rejects it.'''
+        if 'int' in self.capabilities and 'start ftw' in commands.dtype.names:
+            header = ad9914_protocol.integer_header(len(commands))
+            to_records = ad9914_protocol.integer_records
+        else:
+            header = ad9914_protocol.binary_header(len(commands))
+            to_records = ad9914_protocol.binary_records
+        t_start = timer()
+        keep = self._keep_uploaded()
+        records = []
+        def encode(chunk):
+            chunk_records = to_records(chunk)
+            if keep:
+                records.append(chunk_records)
+            return chunk_records.tobytes()
+        _, n_bytes = pico_upload.write_chunked(self.conn, commands, encode, header,
+                                               ad9914_protocol.binary_terminator, keep_rows=False)
+        if keep:
+            records = np.concatenate(records) if records else to_records(commands[:0])
+        else:
+            records = None
+        return self._finish_binary(records, len(commands), n_bytes, t_start)
+
+    def _keep_uploaded(self):
+        '''Whether the records of the next upload are needed, so should be kept.'''
+        return self.keep_uploaded and self.uploaded is not None
+
+    def _finish_binary(self, records, count, n_bytes, t_start):
+        '''Reads the reply to a binary upload of count records, and keeps them for verify
+        (self.uploaded becomes None if records is None).'''
+        resp = self.conn.read_until(b'> ')
+        if pico_protocol.is_error(resp):
+            raise RuntimeError('AD9914 Pico rejected binary upload: {}'
+                               .format(resp.decode(errors='replace').strip()))
+        if records is None:
+            self.uploaded = None
+        elif self.uploaded is not None:
+            self.uploaded.append(records)
+        self._record_upload(count, n_bytes, t_start)
         return resp
 
+    def supports_payload(self, protocol):
+        '''Whether a payload precomputed with the given protocol can be sent to this Pico.'''
+        capability = ad9914_protocol.payload_protocols.get(protocol)
+        return self.binary and capability in self.capabilities
+
+    def add_payload(self, payload, protocol):
+        '''Sends a uint8 payload made by ad9914_protocol.encode_payload
+        (an array or h5py dataset) as is, in chunks as for add_binary.
+        Returns response, throws RuntimeError if the Pico rejects it.'''
+        t_start = timer()
+        count = ad9914_protocol.payload_count(payload, protocol)
+        payload, n_bytes = pico_upload.write_chunked(self.conn, payload, lambda chunk: chunk.tobytes(),
+                                                     keep_rows=self._keep_uploaded())
+        if payload is not None:
+            payload = ad9914_protocol.payload_records(payload, protocol)
+        return self._finish_binary(payload, count, n_bytes, t_start)
+
+    def verify(self):
+        '''Sends 'crc' command, and compares the checksum of the table on the Pico
+        with that of the records uploaded since the last clear.
+        Only if they differ is the table dumped, to find the rows which differ.
+        Throws RuntimeError if the table does not match the upload.'''
+        if self.uploaded is None:
+            raise RuntimeError('AD9914 Pico table was not uploaded as a batch, cannot verify it')
+        if self.uploaded:
+            expected = np.concatenate(self.uploaded)
+        else:
+            expected = np.empty(0, dtype=ad9914_protocol.binary_record_dtype)
+
+        value = pico_protocol.query(self.conn, b'crc')
+        if value is None:
+            raise RuntimeError('AD9914 Pico did not report a checksum')
+        if int(value, 16) == ad9914_protocol.checksum(expected):
+            return
+
+        self.conn.timeout = self.dump_timeout
+        try:
+            actual = ad9914_protocol.parse_dump(self.dump(), expected.dtype)
+        finally:
+            self.conn.timeout = self.timeout
+        rows = ad9914_protocol.diff_records(expected, actual)
+        if not len(rows):
+            raise RuntimeError('AD9914 Pico table checksum does not match the upload, '
+                               'but its dump does')
+        raise RuntimeError('AD9914 Pico table does not match the upload: '
+                           '{:d} of {:d} rows differ, the first is row {:d}'
+                           .format(len(rows), len(expected), rows[0]))
+
     def close(self):
         self.conn.close()
 
+class _TableStreamer(threading.Thread):
+    '''Tops up the table of a streamed run from a background thread,
+    sending more commands whenever the Pico reports free space.'''
+    def __init__(self, intf, commands, poll_interval=5e-3):
+        threading.Thread.__init__(self, daemon=True)
+        self.intf = intf
+        self.commands = commands
+        self.poll_interval = poll_interval
+        self.n_sent = 0
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            while self.n_sent < len(self.commands):
+                if self._stop_event.wait(self.poll_interval):
+                    return
+                with self.intf.lock:
+                    free = self.intf.free()
+                    if free > 0:
+                        chunk = self.commands[self.n_sent:self.n_sent + free]
+                        self.intf.add_batch(chunk)
+                        self.n_sent += len(chunk)
+            with self.intf.lock:
+                self.intf.finish()
+        except Exception as e:
+            self.error = e
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
 class AD9914PicoWorker(Worker):
     def init(self):
         self.intf = AD9914PicoInterface(self.com_port)
+        self.streamer = None
+        # Whether the Pico is known to be running a manual mode table
+        self.manual = False
 
     def program_manual(self, values):
+        freq, amp = values['output']['freq'], values['output']['amp']
+        if self.manual and 'set' in self.intf.capabilities:
+            try:
+                self.intf.set_output(freq, amp)
+                return
+            except RuntimeError:
+                pass # Fall back to the full cycle, which leaves the Pico in a known state
+        self.manual = False # Unknown until programming succeeds
+
         self.intf.abort()
         self.intf.clear()
 
-        self.intf.add(values['output']['freq'], values['output']['amp'], trigger=False)
+        self.intf.add(freq, amp, trigger=False)
 
         self.intf.run()
+        self.manual = True
 
     def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
+        self.manual = False
         final_values = {}
         final_values['dds_data'] = {}
 
         self.intf.clear()
 
+        # Upload while the file is open, so the table is read as it is sent
         with h5py.File(h5file, 'r') as hdf5_file:
             group = hdf5_file['devices'][device_name]
             commands = group['dds_data']
-            self.intf.add_batch(commands)
+
+            # Stream the table if it does not fit on the Pico
+            if 'stream' in self.intf.capabilities and len(commands) > self.intf.free():
+                commands = commands[()]
+                self.intf.stream()
+                n_initial = self.intf.free()
+                self.intf.add_batch(commands[:n_initial])
+                self.log_upload()
+                self.intf.run()
+                self.streamer = _TableStreamer(self.intf, commands[n_initial:])
+                self.streamer.start()
+                return {}
+
+            # Precomputed payload, if the shot file has one this Pico can take
+            if 'payload' in group and self.intf.supports_payload(group['payload'].attrs['protocol']):
+                self.intf.add_payload(group['payload'], group['payload'].attrs['protocol'])
+            else:
+                self.intf.add_batch(commands)
+        self.log_upload()
+        if 'crc' in self.intf.capabilities:
+            self.intf.verify()
 
         self.intf.run()
 
         return {}
 
+    def log_upload(self):
+        stats = self.intf.upload_stats
+        if stats is not None:
+            self.logger.info('Uploaded {:d} commands ({:d} bytes) in {:.3f} s, {:.0f} commands/s'
+                             .format(stats['commands'], stats['bytes'], stats['time'],
+                                     stats['commands_per_s']))
+
+    def stop_streaming(self):
+        '''Stops any streamed run, raising any error the streamer hit.'''
+        if self.streamer is None:
+            return
+        streamer = self.streamer
+        self.streamer = None
+        if streamer.is_alive():
+            streamer.stop()
+            if streamer.n_sent < len(streamer.commands):
+                raise RuntimeError('AD9914 Pico run ended with {:d} of {:d} streamed commands unsent'
+                                   .format(len(streamer.commands) - streamer.n_sent,
+                                           len(streamer.commands)))
+        if streamer.error is not None:
+            raise streamer.error
+
     def transition_to_manual(self):
+        self.stop_streaming()
         return True
 
     def abort_buffered(self):
+        if self.streamer is not None:
+            self.streamer.stop()
+            self.streamer = None
         self.intf.abort()
         return True
 
     def abort_transition_to_buffered(self):
-        self.intf.abort()
-        return True
+        return self.abort_buffered()
 
     def shutdown(self):
+        if self.streamer is not None:
+            self.streamer.stop()
         self.intf.close()
@@ -1,7 +1,62 @@
-from labscript import TriggerableDevice, IntermediateDevice, set_passed_properties
+from labscript import (Device, TriggerableDevice, IntermediateDevice, LabscriptError,
+                       set_passed_properties)
 
 import numpy as np
 
+from user_devices.AD9914_pico import ad9914_protocol
+from user_devices.AD9914_pico.ad9914_protocol import dds_data_dtype
+
+class _CommandTable(object):
+    '''Growable columnar store of AD9914 commands.
+    Each field of dds_data_dtype (plus the start time t) is kept in its own
+    preallocated numpy array, which is doubled in size whenever it fills up.'''
+    def __init__(self, capacity=1024):
+        self.length = 0
+        self.columns = {'t': np.empty(capacity, dtype=float)}
+        for name, dtype in dds_data_dtype:
+            self.columns[name] = np.empty(capacity, dtype=dtype)
+
+    def __len__(self):
+        return self.length
+
+    def append(self, t, start_freq, stop_freq, start_amp, stop_amp, sweep, sweep_time, trigger):
+        '''Append commands. Arguments may be scalars or equal length arrays.'''
+        values = {'t': t,
+                  'start freq': start_freq,
+                  'stop freq': stop_freq,
+                  'start amp': start_amp,
+                  'stop amp': stop_amp,
+                  'sweep': sweep,
+                  'sweep time': sweep_time,
+                  'trigger': trigger}
+        count = max(np.size(value) for value in values.values())
+        capacity = len(self.columns['t'])
+        if self.length + count > capacity:
+            while self.length + count > capacity:
+                capacity *= 2
+            for name, column in self.columns.items():
+                self.columns[name] = np.empty(capacity, dtype=column.dtype)
+                self.columns[name][:self.length] = column[:self.length]
+        for name, value in values.items():
+            self.columns[name][self.length:self.length + count] = value
+        self.length += count
+
+    def to_array(self):
+        '''Returns the commands as a dds_data_dtype structured array, sorted by start time.'''
+        order = np.argsort(self.columns['t'][:self.length], kind='stable')
+        command_array = np.empty(self.length, dtype=dds_data_dtype)
+        for name, _ in dds_data_dtype:
+            command_array[name] = self.columns[name][order]
+        return command_array
+
+class AD9914PicoTrace(Device):
+    '''Names the frequency or amplitude of an AD9914Pico in the connection table,
+    so runviewer can show them as traces. Has no instructions of its own.'''
+    description = 'AD9914 Pico output trace'
+
+    def generate_code(self, hdf5_file):
+        pass
+
 class AD9914Pico(TriggerableDevice):
 
     @set_passed_properties(
@@ -13,36 +68,103 @@ class AD9914Pico(TriggerableDevice):
         }
     )
 
-    def __init__(self, name, parent_device, com_port, **kwargs):
+    def __init__(self, name, parent_device, com_port, quantize=False, sysclk=3.5e9,
+                 merge_segments=False, precompute_payload=False, runviewer_traces=False, **kwargs):
+        '''
+        Args:
+        merge_segments: If True, merge untriggered commands which continue the previous one
+        	(repeated constants, or collinear linear sweeps) before saving the table.
+        quantize: If True, also store the commands in the AD9914's native integer units
+        	(frequency tuning words, amplitude scale factors and SYNC_CLK periods),
+        	merging segments which become identical, so the worker can upload exact integers.
+        sysclk: AD9914 system clock frequency, Hz. Only used when quantizing.
+        precompute_payload: If True, also store the exact bytes of a binary upload
+        	(integer records if quantizing), which the worker sends in a single write
+        	if the firmware supports that encoding.
+        runviewer_traces: If True, add <name>_freq and <name>_amp to the connection table,
+        	so runviewer can show the frequency and amplitude as traces.
+        '''
         self.trigger_edge_type = parent_device.trigger_edge_type
         TriggerableDevice.__init__(self, name, parent_device, connection='trigger', **kwargs)
         self.BLACS_connection = 'AD9914Pico: {}'.format(name)
-        self.command_list = []
+        self.quantize = quantize
+        self.sysclk = sysclk
+        self.merge_segments = merge_segments
+        self.precompute_payload = precompute_payload
+        self.commands = _CommandTable()
+        if runviewer_traces:
+            AD9914PicoTrace('{}_freq'.format(name), self, 'freq')
+            AD9914PicoTrace('{}_amp'.format(name), self, 'amp')
 
     def generate_code(self, hdf5_file):
         TriggerableDevice.generate_code(self, hdf5_file)
 
-        self.command_list.sort(key=lambda cl: cl['t'])
-        command_array = np.empty(len(self.command_list),
-                                 dtype=[('start freq', float),
-                                        ('start amp', float),
-                                        ('stop freq', float),
-                                        ('stop amp', float),
-                                        ('sweep', bool),
-                                        ('sweep time', float),
-                                        ('trigger', bool)])
-        for cl, ca in zip(self.command_list, command_array):
-            ca['start freq'] = cl['start_freq']
-            ca['stop freq'] = cl['stop_freq']
-            ca['start amp'] = cl['start_amp']
-            ca['stop amp'] = cl['stop_amp']
-            ca['sweep'] = cl['sweep']
-            if cl['sweep']:
-                ca['sweep time'] = cl['sweep_time']
-            ca['trigger'] = cl['trigger']
+        command_array = self.commands.to_array()
+        if self.merge_segments:
+            command_array = _merge_segments(command_array)
+        if self.quantize:
+            command_array = self._quantize(command_array)
 
         group = hdf5_file['devices'].require_group(self.name)
-        group.create_dataset('dds_data', data=command_array)
+        dataset = group.create_dataset('dds_data', data=command_array)
+        if self.quantize:
+            dataset.attrs['sysclk'] = self.sysclk
+        if self.precompute_payload:
+            protocol, payload = ad9914_protocol.encode_payload(command_array, self.quantize)
+            dataset = group.create_dataset('payload', data=payload)
+            dataset.attrs['protocol'] = protocol
+
+    def _quantize(self, command_array):
+        '''Add native integer columns to command_array,
+        then drop or merge untriggered sweeps which are redundant once quantized.'''
+        freqs = np.concatenate([command_array['start freq'], command_array['stop freq']])
+        if np.any(freqs < 0) or np.any(freqs >= self.sysclk / 2):
+            raise LabscriptError('{} frequencies must be between 0 and {} Hz to quantize'
+                                 .format(self.name, self.sysclk / 2))
+        amps = np.concatenate([command_array['start amp'], command_array['stop amp']])
+        if np.any(amps < 0) or np.any(amps > 1):
+            raise LabscriptError('{} amplitudes must be between 0 and 1 to quantize'
+                                 .format(self.name))
+        max_sweep_time = ad9914_protocol.max_sweep_ticks * 24 / self.sysclk
+        sweep_times = command_array['sweep time'][command_array['sweep']]
+        if np.any(np.round(sweep_times * self.sysclk / 24) > ad9914_protocol.max_sweep_ticks):
+            raise LabscriptError('{} ramps must be shorter than {} s to quantize'
+                                 .format(self.name, max_sweep_time))
+
+        quantized = ad9914_protocol.quantize(command_array, self.sysclk)
+        sweep = quantized['sweep']
+        trigger = quantized['trigger']
+
+        if np.any(sweep & trigger & (quantized['sweep ticks'] == 0)):
+            raise LabscriptError('{} has a ramp shorter than the AD9914 time resolution of {} s'
+                                 .format(self.name, 24 / self.sysclk))
+        # Untriggered sweeps shorter than one tick never play, so drop them
+        quantized = quantized[~(sweep & ~trigger & (quantized['sweep ticks'] == 0))]
+
+        # Merge untriggered flat sweeps into a preceding flat sweep at the same values,
+        # which can simply hold those values for longer
+        flat = (quantized['sweep']
+                & (quantized['start ftw'] == quantized['stop ftw'])
+                & (quantized['start asf'] == quantized['stop asf']))
+        merge = np.zeros(len(quantized), dtype=bool)
+        merge[1:] = (flat[1:] & flat[:-1] & ~quantized['trigger'][1:]
+                     & (quantized['start ftw'][1:] == quantized['start ftw'][:-1])
+                     & (quantized['start asf'][1:] == quantized['start asf'][:-1]))
+        keep = np.flatnonzero(~merge)
+        merged = quantized[keep]
+        if len(keep):
+            ticks = np.add.reduceat(quantized['sweep ticks'].astype(np.uint64), keep)
+            if np.any(ticks > ad9914_protocol.max_sweep_ticks):
+                # Merged holds too long for a record, so leave them as they are
+                merged = quantized
+            else:
+                merged['sweep ticks'] = ticks
+                merged['sweep time'] = np.add.reduceat(quantized['sweep time'], keep)
+
+        if len(merged) < len(command_array):
+            print('{}: quantizing removed {:d} of {:d} commands'
+                  .format(self.name, len(command_array) - len(merged), len(command_array)))
+        return merged
 
     def ramp(self, t, duration, start_freq, stop_freq, start_amp, stop_amp):
         '''
@@ -57,15 +179,8 @@ class AD9914Pico(TriggerableDevice):
         start_amp: Amplitude to start at, arbitrary units from 1.0 to 0.0
         stop_amp: Amplitude to stop at, arbitrary units from 1.0 to 0.0
         '''
-        self.command_list.append({'t': t,
-                                  'start_freq': start_freq,
-                                  'stop_freq': stop_freq,
-                                  'start_amp': start_amp,
-                                  'stop_amp': stop_amp,
-                                  'sweep': True,
-                                  'sweep_time': duration,
-                                  'trigger': True,
-                                  })
+        self.commands.append(t, start_freq, stop_freq, start_amp, stop_amp,
+                             sweep=True, sweep_time=duration, trigger=True)
         self.trigger(t=t, duration=duration/2.)
 
     def constant(self, t, freq, amp):
@@ -77,14 +192,7 @@ class AD9914Pico(TriggerableDevice):
         freq: Frequency to set, Hz
         amp: Amplitude to set, arbitrary units from 1.0 to 0.0
         '''
-        self.command_list.append({'t': t,
-                                  'start_freq': freq,
-                                  'stop_freq': freq,
-                                  'start_amp': amp,
-                                  'stop_amp': amp,
-                                  'sweep': False,
-                                  'trigger': True,
-                                  })
+        self.commands.append(t, freq, freq, amp, amp, sweep=False, sweep_time=0, trigger=True)
         self.trigger(t=t, duration=2e-6) # Need to be >1e-6s for safe triggering with NI card
 
     def customramp(self, t, duration, freq_function, amp_function, **kwargs):
@@ -94,6 +202,17 @@ class AD9914Pico(TriggerableDevice):
         which instructs Labscript how many linear ramps to divide the functions into.
         A trigger is set at the start of the ramps, but not for the intermediate ones.
 
+        The functions are evaluated once on an array of times where possible.
+        Functions which cannot take an array are evaluated at each time in turn,
+        and kwargs may include vectorized=False to always do this.
+
+        If kwargs include freq_tolerance (Hz) and/or amp_tolerance,
+        the samples are instead joined into as few linear ramps as possible
+        while keeping the error at every sample within the tolerances.
+        Breakpoints are still placed on the samplerate grid,
+        so samplerate sets the shortest possible ramp.
+        A tolerance which is not given is taken to be zero.
+
         Args:
         t: Time to start ramps at
         duration: Total ramp time
@@ -104,44 +223,140 @@ class AD9914Pico(TriggerableDevice):
         	Should be a function with one argument: the time relative to the ramp start time.
         	Output should be a amplitude between 0.0 and 1.0.
         '''
-        t_step = 1. / kwargs.pop('samplerate')
-
-        first_linear = True
-        t_rel = 0
-        next_freq = freq_function(0)
-        next_amp = amp_function(0)
-
-        while t_rel < duration - t_step:
-            start_freq = next_freq
-            start_amp = next_amp
-            t_rel = t_rel + t_step
-            next_freq = freq_function(t_rel)
-            next_amp = amp_function(t_rel)
-
-            self.command_list.append({'t': t + t_rel - t_step,
-                                      'start_freq': start_freq,
-                                      'stop_freq': next_freq,
-                                      'start_amp': start_amp,
-                                      'stop_amp': next_amp,
-                                      'sweep': True,
-                                      'sweep_time': t_step,
-                                      'trigger': first_linear
-                                      })
-
-            first_linear = False
-
-        start_freq = next_freq
-        start_amp = next_amp
-        next_freq = freq_function(duration)
-        next_amp = amp_function(duration)
-
-        self.command_list.append({'t': t + t_rel - t_step,
-                                  'start_freq': start_freq,
-                                  'stop_freq': next_freq,
-                                  'start_amp': start_amp,
-                                  'stop_amp': next_amp,
-                                  'sweep': True,
-                                  'sweep_time': duration + t_step - (t + t_rel),
-                                  'trigger': False
-                                  })
+        samplerate = kwargs.pop('samplerate')
+        vectorized = kwargs.pop('vectorized', True)
+        freq_tolerance = kwargs.pop('freq_tolerance', None)
+        amp_tolerance = kwargs.pop('amp_tolerance', None)
+
+        # Build the time grid from integer sample indices, so rounding errors do not accumulate
+        n_steps = max(int(np.ceil(duration * samplerate - 1e-6)), 1)
+        t_rel = np.arange(n_steps + 1) / samplerate
+        t_rel[-1] = duration
+
+        freqs = _evaluate_ramp_function(freq_function, t_rel, vectorized)
+        amps = _evaluate_ramp_function(amp_function, t_rel, vectorized)
+
+        if freq_tolerance is not None or amp_tolerance is not None:
+            breakpoints = _fit_breakpoints(t_rel, [freqs, amps],
+                                           [freq_tolerance or 0, amp_tolerance or 0])
+            freq_error = np.max(np.abs(np.interp(t_rel, t_rel[breakpoints], freqs[breakpoints])
+                                       - freqs))
+            amp_error = np.max(np.abs(np.interp(t_rel, t_rel[breakpoints], amps[breakpoints])
+                                      - amps))
+            print('{}: customramp at t={} uses {:d} segments instead of {:d}, '
+                  'max error {:.3g} Hz in frequency and {:.3g} in amplitude'
+                  .format(self.name, t, len(breakpoints) - 1, n_steps, freq_error, amp_error))
+            t_rel = t_rel[breakpoints]
+            freqs = freqs[breakpoints]
+            amps = amps[breakpoints]
+            n_steps = len(breakpoints) - 1
+
+        trigger = np.zeros(n_steps, dtype=bool)
+        trigger[0] = True
+
+        self.commands.append(t + t_rel[:-1], freqs[:-1], freqs[1:], amps[:-1], amps[1:],
+                             sweep=True, sweep_time=np.diff(t_rel), trigger=trigger)
         self.trigger(t=t, duration=duration/2.)
+
+def _evaluate_ramp_function(function, t_rel, vectorized=True):
+    '''Evaluate function at each time in t_rel, returning an array of floats.
+    Tries a single call on the whole array first (if vectorized),
+    falling back to one call per time for functions that only accept scalars.'''
+    if vectorized:
+        try:
+            values = np.asarray(function(t_rel), dtype=float)
+        except Exception:
+            values = None
+        if values is not None and values.shape in [(), t_rel.shape]:
+            return np.broadcast_to(values, t_rel.shape)
+    return np.array([function(t) for t in t_rel], dtype=float)
+
+def _fit_breakpoints(t, values, tolerances):
+    '''Douglas-Peucker fit of a piecewise linear function to samples.
+    values is a list of arrays sampled at times t, with a matching list of tolerances.
+    Returns the indices of the samples to keep as breakpoints,
+    such that linear interpolation between them stays within tolerance of every sample.'''
+    # Floor tolerances slightly above rounding error, so that exactly linear sections merge
+    tolerances = [max(tol, 1e-12 * np.max(np.abs(v))) for v, tol in zip(values, tolerances)]
+
+    keep = np.zeros(len(t), dtype=bool)
+    keep[0] = True
+    keep[-1] = True
+    spans = [(0, len(t) - 1)]
+    while spans:
+        i, j = spans.pop()
+        if j - i < 2:
+            continue
+        frac = (t[i+1:j] - t[i]) / (t[j] - t[i])
+        error = np.zeros(j - i - 1)
+        for v, tol in zip(values, tolerances):
+            if tol > 0:
+                error = np.maximum(error, np.abs(v[i+1:j] - (v[i] + frac * (v[j] - v[i]))) / tol)
+        worst = np.argmax(error)
+        if error[worst] > 1:
+            k = i + 1 + worst
+            keep[k] = True
+            spans.append((i, k))
+            spans.append((k, j))
+    return np.flatnonzero(keep)
+
+def _merge_segments(commands, rtol=1e-9):
+    '''Merge runs of untriggered commands in a sorted dds_data array which continue
+    the command before them: repeats of a constant, or linear sweeps which carry on
+    along the same line. Triggered commands always start a new entry.
+    Values closer than rtol (relative to the largest value) are treated as equal.'''
+    if len(commands) < 2:
+        return commands
+    freq_tol = rtol * max(np.max(np.abs(commands['start freq'])),
+                          np.max(np.abs(commands['stop freq'])))
+    amp_tol = rtol * max(np.max(np.abs(commands['start amp'])),
+                         np.max(np.abs(commands['stop amp'])))
+    sweep = commands['sweep']
+    sweep_time = np.where(sweep, commands['sweep time'], 0)
+
+    def continues(this_field, previous_field, tol):
+        return np.abs(commands[this_field][1:] - commands[previous_field][:-1]) <= tol
+
+    def same_slope(field, tol):
+        change = commands['stop ' + field] - commands['start ' + field]
+        return (np.abs(change[1:] * sweep_time[:-1] - change[:-1] * sweep_time[1:])
+                <= tol * (sweep_time[:-1] + sweep_time[1:]))
+
+    merge = np.zeros(len(commands), dtype=bool)
+    merge[1:] = ~commands['trigger'][1:] & (
+        # Constant repeating the previous constant
+        (~sweep[1:] & ~sweep[:-1]
+         & continues('start freq', 'start freq', freq_tol)
+         & continues('start amp', 'start amp', amp_tol))
+        # Sweep carrying on from where the previous sweep stopped, at the same rate
+        | (sweep[1:] & sweep[:-1]
+           & continues('start freq', 'stop freq', freq_tol)
+           & continues('start amp', 'stop amp', amp_tol)
+           & same_slope('freq', freq_tol) & same_slope('amp', amp_tol)))
+
+    # Small slope differences could add up along a long run, so also check that every
+    # breakpoint lies on the line from the start of the run to its end,
+    # and leave runs which do not unmerged
+    head = np.flatnonzero(~merge)
+    group = np.cumsum(~merge) - 1
+    last = np.append(head[1:], len(commands)) - 1
+    elapsed = np.cumsum(sweep_time)
+    elapsed -= (elapsed - sweep_time)[head][group]
+    total = np.add.reduceat(sweep_time, head)[group]
+    fraction = np.divide(elapsed, total, out=np.ones_like(elapsed), where=total > 0)
+    bad = np.zeros(len(commands), dtype=bool)
+    for field, tol in [('freq', freq_tol), ('amp', amp_tol)]:
+        start = commands['start ' + field][head][group]
+        stop = commands['stop ' + field][last][group]
+        bad |= np.abs(start + (stop - start) * fraction - commands['stop ' + field]) > tol
+    bad_group = np.zeros(len(head), dtype=bool)
+    bad_group[group[bad]] = True
+    merge &= ~bad_group[group]
+
+    head = np.flatnonzero(~merge)
+    last = np.append(head[1:], len(commands)) - 1
+    merged = commands[head]
+    merged['stop freq'] = commands['stop freq'][last]
+    merged['stop amp'] = commands['stop amp'][last]
+    merged['sweep time'] = np.where(merged['sweep'], np.add.reduceat(sweep_time, head), 0)
+    return merged
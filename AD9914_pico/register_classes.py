@@ -3,5 +3,5 @@ from labscript_devices import register_classes
 register_classes(
     'AD9914Pico',
     BLACS_tab='user_devices.AD9914_pico.blacs_tabs.AD9914PicoTab',
-    runviewer_parser=None,
+    runviewer_parser='user_devices.AD9914_pico.runviewer_parsers.AD9914PicoParser',
 )
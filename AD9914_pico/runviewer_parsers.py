@@ -0,0 +1,84 @@
+import labscript_utils.h5_lock, h5py
+import numpy as np
+
+# Most points drawn for a single ramp, since runviewer holds each value until the next
+max_ramp_points = 64
+# Points spread over the ramps of a trace in proportion to their durations
+ramp_points_budget = 1000
+
+class AD9914PicoParser(object):
+    def __init__(self, path, device):
+        self.path = path
+        self.name = device.name
+        self.device = device
+
+    def get_traces(self, add_trace, clock=None):
+        with h5py.File(self.path, 'r') as f:
+            commands = f['devices'][self.name]['dds_data'][()]
+        if not len(commands):
+            return {}
+
+        if clock is not None:
+            times, clock_value = clock[0], clock[1]
+            clock_indices = np.flatnonzero(np.diff(clock_value) == 1) + 1
+            # A trigger which starts high has a rising edge at the start too
+            if clock_value[0] == 1:
+                clock_indices = np.insert(clock_indices, 0, 0)
+            t_origin = times[0]
+            trigger_times = times[clock_indices]
+        else:
+            t_origin = 0
+            trigger_times = np.zeros(0)
+
+        # Each triggered command starts at the next rising edge of the trigger,
+        # and each untriggered one as soon as the previous command finishes.
+        # Commands before the first trigger start with the run.
+        trigger_index = np.cumsum(commands['trigger']) - 1
+        if np.any(trigger_index >= len(trigger_times)):
+            n_missing = trigger_index.max() + 1 - len(trigger_times)
+            trigger_times = np.append(trigger_times, np.full(n_missing, np.nan))
+        group_start = np.full(len(commands), float(t_origin))
+        triggered = trigger_index >= 0
+        group_start[triggered] = trigger_times[trigger_index[triggered]]
+        duration = np.where(commands['sweep'], commands['sweep time'], 0)
+        elapsed = np.cumsum(duration) - duration
+        # Subtract the time elapsed before the first command of each triggered group
+        new_group = np.diff(trigger_index, prepend=trigger_index[0] - 1) != 0
+        elapsed -= elapsed[np.flatnonzero(new_group)][np.cumsum(new_group) - 1]
+        start = group_start + elapsed
+
+        for quantity in ['freq', 'amp']:
+            start_value = commands['start ' + quantity]
+            stop_value = np.where(commands['sweep'], commands['stop ' + quantity], start_value)
+            trace = self._points(start, duration, start_value, stop_value)
+
+            name = '{}_{}'.format(self.name, quantity)
+            # Traces can only be added for outputs in the connection table
+            if name in self.device.child_list:
+                add_trace(name, trace, self.name, quantity)
+
+        return {}
+
+    @staticmethod
+    def _points(start, duration, start_value, stop_value):
+        '''Returns the (times, values) of a trace, with a point at the start of each command,
+        and for commands which change the value, points at up to max_ramp_points evenly
+        spaced times through the ramp, the last at its end. Since runviewer holds each value
+        until the next point, the ramps get points in proportion to their share of the time
+        the commands span, so the points grow with the number of commands plus a fixed budget.'''
+        ramps = stop_value != start_value
+        stop = start + duration
+        span = np.nanmax(stop) - np.nanmin(start)
+        n_steps = np.zeros(len(start), dtype=int)
+        if span > 0:
+            n_steps[ramps] = np.ceil(ramp_points_budget * duration[ramps] / span)
+        n_steps = np.where(ramps, np.clip(n_steps, 1, max_ramp_points), 0)
+
+        counts = n_steps + 1
+        command_index = np.repeat(np.arange(len(start)), counts)
+        point_index = np.arange(len(command_index)) - np.repeat(np.cumsum(counts) - counts, counts)
+        fraction = point_index / np.maximum(n_steps, 1)[command_index]
+        times = start[command_index] + fraction * duration[command_index]
+        values = start_value[command_index] + fraction * (stop_value - start_value)[command_index]
+        valid = ~np.isnan(times)
+        return times[valid], values[valid]
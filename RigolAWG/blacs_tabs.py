@@ -12,6 +12,9 @@ class Rigol4162Tab(DeviceTab):
 
         self.access_mode = device.properties['access_mode']
         self.resource_str = device.properties['resource_str']
+        # Absent from connection tables compiled before they were added
+        self.compound_commands = device.properties.get('compound_commands', True)
+        self.pacing = device.properties.get('pacing', 'fixed')
 
         self._output_sets = {}
 
@@ -74,6 +77,12 @@ class Rigol4162Tab(DeviceTab):
 
             self._output_sets['channel {}'.format(channel)] = outputs
 
+        # Only settings which changed since they were last sent are resent
+        self.supports_smart_programming(True)
+        # The worker can read the settings back (check_remote_values), but the outputs
+        # are not registered with DeviceTab, which could then not show or apply differences
+        self.supports_remote_value_check(False)
+
         return
 
     def initialise_workers(self):
@@ -83,6 +92,8 @@ class Rigol4162Tab(DeviceTab):
             {
                 'resource_str': self.resource_str,
                 'access_mode': self.access_mode,
+                'compound_commands': self.compound_commands,
+                'pacing': self.pacing,
                 'initial_front_panel_values': self.get_front_panel_values()
             },
             )
@@ -1,19 +1,63 @@
 from blacs.tab_base_classes import Worker
 import labscript_utils.h5_lock, h5py
+import numpy as np
+from labscript_utils.labconfig import LabConfig
+import json
+import math
+import os
+import re
+from contextlib import contextmanager
+from enum import Enum
+from functools import wraps
 from time import sleep
+from timeit import default_timer as timer
+
+from user_devices.RigolAWG.rigol_awg_enums import *
 
 class _RigolIO():
-    def __init__(self, resource_str, access_mode):
+    max_line_length = 250 # Longest compound command line sent, well within the input buffer
+    timeout = 5 # Seconds to wait for a reply over Ethernet
+    default_settle_time = 20e-3 # Settle time assumed for commands not yet timed by 'opc' pacing
+    settle_smoothing = 0.3 # Weight of each new timing in the learnt settle times
+    # With 'opc' pacing, lines of commands learnt to be quick are sent without waiting,
+    # until they are predicted to take this long, then confirmed with a single '*OPC?'
+    max_unconfirmed_time = 50e-3
+
+    def __init__(self, resource_str, access_mode, compound_commands=True, pacing='fixed'):
+        '''
+        Args:
+        compound_commands: Whether batch joins commands into compound lines.
+        pacing: How lines sent over Ethernet are paced. 'fixed' pauses 20 ms after each line.
+            'opc' follows lines with '*OPC?' and waits for the reply, so they take as long
+            as the Rigol needs, and learns the settle time of each command from them.
+            Within a batch, lines of commands learnt to be quick share an '*OPC?'.
+        '''
         assert access_mode in ['eth', 'usb'], 'access_mode must be one of \'eth\' or \'usb\''
+        assert pacing in ['fixed', 'opc'], 'pacing must be one of \'fixed\' or \'opc\''
         self.access_mode = access_mode
+        self.compound_commands = compound_commands
+        self.pacing = pacing
+        self._batching = False
+        self._queued = None # Commands waiting to be sent, while batching compound lines
+        self._on_failure = [] # Called if the commands of the batch may not all have been sent
+        self.n_written = 0 # Commands written so far, to tell if settings may have changed
+        # Learnt time for the Rigol to complete each command header, with 'opc' pacing
+        self.settle_times = {}
+        self._unconfirmed = [] # Headers of the commands sent since the last '*OPC?'
 
         if self.access_mode == 'eth':
             import socket
 
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.connect((resource_str, 5555))
+            self.socket.settimeout(self.timeout)
 
-            self.rigol = self.socket.makefile('brw')
+            if self.pacing == 'opc':
+                # Lines are sent whole with sendall, so do not let Nagle's algorithm hold them
+                self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.rigol = self.socket.makefile('rb')
+            else:
+                self.rigol = self.socket.makefile('brw')
         elif self.access_mode == 'usb':
             import pyvisa
 
@@ -22,25 +66,186 @@ class _RigolIO():
 
         return
 
-    def write(self, command):
-        command = command + '\n'
-        if self.socket is not None:
-            command = command.encode('ascii')
+    @contextmanager
+    def batch(self):
+        '''Queues the commands written within, then sends them joined with ';'
+        into as few compound lines of up to max_line_length as possible,
+        so the pacing between lines is paid once per line rather than once per command.
+        If compound_commands is False, each command is still sent on its own line.
+        With 'opc' pacing, waits for the Rigol to complete them all before returning.
+        Does nothing if already batching.'''
+        if self._batching:
+            yield
+            return
+        self._batching = True
+        self._queued = [] if self.compound_commands else None
+        self._on_failure = []
+        try:
+            yield
+            self.flush()
+            self._confirm()
+        except Exception:
+            # Commands queued earlier in the batch may never have been sent
+            for callback in self._on_failure:
+                callback()
+            raise
+        finally:
+            self._batching = False
+            self._queued = None
+            self._on_failure = []
+
+    def on_failure(self, callback):
+        '''Calls callback if the batch being queued fails before all its commands are sent.
+        Does nothing if not batching, as the commands are then sent as they are written.'''
+        if self._batching and callback not in self._on_failure:
+            self._on_failure.append(callback)
+
+    def flush(self):
+        '''Sends any commands queued by batch.'''
+        if not self._queued:
+            return
+        commands = self._queued
+        self._queued = []
+        line = commands[0]
+        for command in commands[1:]:
+            if len(line) + 1 + len(command) > self.max_line_length:
+                self._send(line)
+                line = command
+            else:
+                line += ';' + command
+        self._send(line)
+
+    def write(self, command, standalone=False):
+        '''Sends a command, or queues it while batching.
+        A standalone command is always sent on its own line, after any queued commands,
+        for commands the Rigol mishandles within a compound line.'''
+        self.n_written += 1
+        if self._queued is not None and not standalone:
+            self._queued.append(command)
+            return
+        self.flush()
+        self._send(command)
+        if not self._batching:
+            self._confirm()
 
-        self.rigol.write(command)
-        if self.socket is not None:
-            self.rigol.flush()
+        return
+
+    def _send(self, line):
+        '''Sends a line of commands, paced as set by pacing.'''
+        if self.socket is None:
+            self.rigol.write(line + '\n')
+        elif self.pacing == 'opc':
+            headers = [_command_header(command) for command in line.split(';')]
+            if not self._unconfirmed:
+                self._t_unconfirmed = timer()
+            self._transmit(line + '\n')
+            self._unconfirmed.extend(headers)
+            # Only lines of commands already timed, and quick together, go unconfirmed
+            if (any(header not in self.settle_times for header in headers)
+                    or self._predict_settle_time(self._unconfirmed) > self.max_unconfirmed_time):
+                self._confirm()
+        else:
+            self._transmit(line + '\n')
             sleep(20e-3) # Rigol gets sad if commands come too fast. 20ms is empirical limit.
 
         return
 
-    def query(self, command):
+    def write_block(self, command, data):
+        '''Sends command followed by data (bytes) as an IEEE 488.2 definite length block,
+        e.g. ':TRAC:DATA:DAC VOLATILE,#516384<data>', then waits for the Rigol to finish with it.'''
+        self.flush()
+        self.n_written += 1
+        length = str(len(data))
+        message = (command + '#{:d}{}'.format(len(length), length)).encode('ascii') + data + b'\n'
         if self.socket is not None:
-            self.write(command)
+            self._transmit(message)
+        else:
+            self.rigol.write_raw(message)
+        # Storing a long waveform takes much longer than any fixed pause
+        self.query('*OPC?')
+        return
+
+    def _transmit(self, data):
+        '''Writes data (a string or bytes) to the socket as is.'''
+        if isinstance(data, str):
+            data = data.encode('ascii')
+        if self.pacing == 'opc':
+            self.socket.sendall(data)
+        else:
+            self.rigol.write(data)
+            self.rigol.flush()
+
+    def _read_reply(self):
+        resp = self.rigol.readline().decode('ascii').strip()
+        self.rigol.readline() # Rigol sends blank line afterwards
+        return resp
+
+    def _confirm(self):
+        '''With 'opc' pacing, waits for the Rigol to complete the lines sent since
+        the last '*OPC?', and learns the settle times of their commands.'''
+        if self.socket is None or self.pacing != 'opc' or not self._unconfirmed:
+            return
+        headers = self._unconfirmed
+        self._unconfirmed = []
+        predicted = self._predict_settle_time(headers)
+        # On a line of its own, so commands which must be standalone stay so
+        self._transmit('*OPC?\n')
+        # Allow for commands which legitimately take a long time
+        self.socket.settimeout(self.timeout + 10 * predicted)
+        try:
+            self._read_reply()
+        finally:
+            self.socket.settimeout(self.timeout)
+        self._learn_settle_time(headers, predicted, timer() - self._t_unconfirmed)
+
+    def _predict_settle_time(self, headers):
+        '''Predicted time for the Rigol to complete commands with these headers.'''
+        return sum(self.settle_times.get(header, self.default_settle_time) for header in headers)
+
+    def _learn_settle_time(self, headers, predicted, duration):
+        '''Updates the settle time of each command header of commands which took duration
+        to complete, sharing duration among them in proportion to their predicted times.'''
+        shares = {}
+        counts = {}
+        for header in headers:
+            share = self.settle_times.get(header, self.default_settle_time) / predicted
+            shares[header] = shares.get(header, 0) + share * duration
+            counts[header] = counts.get(header, 0) + 1
+        for header, total in shares.items():
+            # The settle time is per command, so average over repeats of the header
+            measured = total / counts[header]
+            old = self.settle_times.get(header, measured)
+            self.settle_times[header] = ((1 - self.settle_smoothing) * old
+                                         + self.settle_smoothing * measured)
+
+    def query_batch(self, commands):
+        '''Sends queries joined into compound lines (one query per line if not
+        compound_commands), and returns the list of their replies.'''
+        if not self.compound_commands:
+            return [self.query(command) for command in commands]
+        replies = []
+        line = []
+        for n, command in enumerate(commands):
+            line.append(command)
+            if n + 1 == len(commands) or len(';'.join(line + [commands[n + 1]])) > self.max_line_length:
+                reply = self.query(';'.join(line)).split(';')
+                if len(reply) != len(line):
+                    raise RuntimeError('Rigol sent {:d} replies to {:d} queries'
+                                       .format(len(reply), len(line)))
+                replies.extend(value.strip() for value in reply)
+                line = []
+        return replies
 
-            resp = self.rigol.readline().decode('ascii').strip()
-            self.rigol.readline() # Rigol sends blank line afterwards
-            return resp
+    def query(self, command):
+        self.flush()
+        self._confirm()
+        if self.socket is not None:
+            if self.pacing == 'opc':
+                # The reply itself shows the Rigol is done
+                self._transmit(command + '\n')
+            else:
+                self._send(command)
+            return self._read_reply()
         else:
             return self.rigol.query(command)
 
@@ -51,18 +256,151 @@ class _RigolIO():
             self.socket.close()
         return
 
+def _command_header(command):
+    '''The header of a command, without its parameters or channel number,
+    e.g. ':SOUR:FREQ' for ':SOUR1:FREQ 1000'.'''
+    return re.sub(r'(SOUR|OUTP)\d', r'\1', command.strip().split(' ')[0])
+
+def _parse_setting(reply, kind):
+    '''Parses the reply to a query as kind, which is float, int,
+    or an Enum of the short forms of an enumeration, e.g. 'LINear' is parsed as 'LIN'.'''
+    if isinstance(kind, type) and issubclass(kind, Enum):
+        for member in kind:
+            if reply.upper().startswith(member.name.upper()):
+                return member.name
+        return reply
+    try:
+        return kind(float(reply))
+    except ValueError:
+        return reply # e.g. MIN, if echoed back as sent
+
+def _setting_matches(reply, value):
+    '''Whether the reply to a query reads back a setting sent as value.'''
+    if value == 'MIN':
+        return True # The minimum is not known here
+    try:
+        return math.isclose(float(reply), float(value), rel_tol=1e-6, abs_tol=1e-9)
+    except ValueError:
+        # Enumerations may be read back in their long form, e.g. LINear
+        return reply.upper().startswith(str(value).upper())
+
+def _batched(method):
+    '''Sends the commands written by a channel method as compound lines (see _RigolIO.batch).
+    If it fails, or an enclosing batch fails to send them, the settings last sent
+    are forgotten, since some may not have been sent.'''
+    @wraps(method)
+    def batched_method(self, *args, **kwargs):
+        self.io.on_failure(self.forget)
+        try:
+            with self.io.batch():
+                return method(self, *args, **kwargs)
+        except Exception:
+            self.forget()
+            raise
+    return batched_method
+
 class _RigolDG4162InterfaceChannel(object):
+    # Settings last sent, which are only resent when they change.
+    # waveform_hash is not saved, since the volatile waveform is lost if the Rigol is power cycled
+    _cache_fields = ['state', 'mode', 'freq', 'amplitude', 'freq_2', 'time',
+                     'time_hold_start', 'time_hold_stop', 'time_return', 'spacing', 'steps',
+                     'trigger_slope', 'trigger_source', 'trigger_out',
+                     'mod_amp', 'mod_source', 'mod_shape', 'cycles']
+
+    # Queries reading back the settings of each mode
+    _setting_queries = {
+        'static': [('freq', ':SOUR{:d}:FREQ?'),
+                   ('amplitude', ':SOUR{:d}:VOLT?')],
+        'sweep': [('freq', ':SOUR{:d}:FREQ:STAR?'),
+                  ('freq_2', ':SOUR{:d}:FREQ:STOP?'),
+                  ('amplitude', ':SOUR{:d}:VOLT?'),
+                  ('time', ':SOUR{:d}:SWE:TIME?'),
+                  ('time_hold_start', ':SOUR{:d}:SWE:HTIM:STAR?'),
+                  ('time_hold_stop', ':SOUR{:d}:SWE:HTIM:STOP?'),
+                  ('time_return', ':SOUR{:d}:SWE:HTIM:RTIM?'),
+                  ('spacing', ':SOUR{:d}:SWE:SPAC?'),
+                  ('steps', ':SOUR{:d}:SWE:STEP?'),
+                  ('trigger_slope', ':SOUR{:d}:SWE:TRIG:SLOP?'),
+                  ('trigger_source', ':SOUR{:d}:SWE:TRIG:SOUR?'),
+                  ('trigger_out', ':SOUR{:d}:SWE:TRIG:TRIGO?')],
+        'fm_mod': [('freq', ':SOUR{:d}:FREQ?'),
+                   ('freq_2', ':SOUR{:d}:MOD:FM:INT:FREQ?'),
+                   ('amplitude', ':SOUR{:d}:VOLT?'),
+                   ('mod_amp', ':SOUR{:d}:MOD:FM:DEV?'),
+                   ('mod_source', ':SOUR{:d}:MOD:FM:SOUR?'),
+                   ('mod_shape', ':SOUR{:d}:MOD:FM:INT:FUNC?')],
+        'arb': [('freq', ':SOUR{:d}:FREQ?'),
+                ('amplitude', ':SOUR{:d}:VOLT?'),
+                ('cycles', ':SOUR{:d}:BURS:NCYC?')],
+    }
+
+    # How the reply reading back each setting is parsed
+    _setting_types = {'freq': float, 'freq_2': float, 'amplitude': float, 'time': float,
+                      'time_hold_start': float, 'time_hold_stop': float, 'time_return': float,
+                      'spacing': RigolDG4162EnumSpacing, 'steps': int,
+                      'trigger_slope': RigolDG4162EnumTriggerSlope,
+                      'trigger_source': RigolDG4162EnumTriggerSource,
+                      'trigger_out': RigolDG4162EnumTriggerOut,
+                      'mod_amp': float, 'mod_source': RigolDG4162EnumModSource,
+                      'mod_shape': RigolDG4162EnumModShape, 'cycles': int}
+
     def __init__(self, channel, io):
         self.channel = channel
         self.io = io
 
-        self.state = 0
-        self.mode = None
+        self.forget()
+
+        return
 
+    def forget(self):
+        '''Marks the settings of the channel as unknown, so all are sent next time.'''
         self._clear()
+        self.state = None
+        self.mode = None
+        return
 
+    def get_cache(self):
+        '''Returns the settings last sent, as a dict which can be saved as JSON.'''
+        cache = {}
+        for name in self._cache_fields:
+            value = getattr(self, name)
+            # Values read from the shot file are numpy scalars
+            cache[name] = value.item() if hasattr(value, 'item') else value
+        return cache
+
+    def set_cache(self, cache):
+        '''Takes the settings last sent from a dict returned by get_cache.'''
+        for name in self._cache_fields:
+            setattr(self, name, cache.get(name))
+        # The waveform in volatile memory cannot be read back, so is uploaded again
+        self.waveform_hash = None
         return
 
+    def cache_queries(self):
+        '''Returns (query, setting) pairs of the queries which read back the settings
+        last sent, and the value each reply should match.'''
+        queries = []
+        if self.state is not None:
+            queries.append((':OUTP{:d}:STAT?'.format(self.channel), 'ON' if self.state else 'OFF'))
+        if self.mode is not None:
+            queries.append((':SOUR{:d}:SWE:STAT?'.format(self.channel),
+                            'ON' if self.mode == 'sweep' else 'OFF'))
+            queries.append((':SOUR{:d}:MOD:STAT?'.format(self.channel),
+                            'ON' if self.mode == 'fm_mod' else 'OFF'))
+            queries.append((':SOUR{:d}:VOLT:UNIT?'.format(self.channel), 'DBM'))
+            queries.append((':SOUR{:d}:FUNC:SHAP?'.format(self.channel),
+                            'USER' if self.mode == 'arb' else 'SIN'))
+            for name, query in self._setting_queries[self.mode]:
+                # Settings which are only sent in some cases
+                if name == 'steps' and self.spacing != 'STE':
+                    continue
+                if name == 'mod_shape' and self.mod_source != 'INT':
+                    continue
+                if name == 'cycles' and not self.cycles:
+                    continue
+                queries.append((query.format(self.channel), getattr(self, name)))
+        return queries
+
     def _clear(self):
         # Static variables
         self.freq = None
@@ -85,22 +423,49 @@ class _RigolDG4162InterfaceChannel(object):
         self.mod_source = None
         self.mod_shape = None
 
+        # Arbitrary waveform variables
+        self.cycles = None
+        self.waveform_hash = None
+
         return
 
+    def mode_queries(self):
+        '''Returns the queries for the output state, sweep state, modulation state
+        and waveform shape, whose replies read_mode parses.'''
+        return [':OUTP{:d}:STAT?'.format(self.channel),
+                ':SOUR{:d}:SWE:STAT?'.format(self.channel),
+                ':SOUR{:d}:MOD:STAT?'.format(self.channel),
+                ':SOUR{:d}:FUNC:SHAP?'.format(self.channel)]
+
+    def read_mode(self, replies):
+        '''Returns (state, mode) from the replies to mode_queries.'''
+        state, sweep, mod = [reply.upper() in ['ON', '1'] for reply in replies[:3]]
+        if sweep:
+            return int(state), 'sweep'
+        elif mod:
+            return int(state), 'fm_mod'
+        elif replies[3].upper().startswith('USER'):
+            return int(state), 'arb'
+        return int(state), 'static'
+
     def get_state(self):
         return self.io.query(':OUTP{:d}:STAT?'.format(self.channel))
 
     def get_mode(self):
         return self.mode
 
+    @_batched
     def output_on(self, fresh=False):
-        if self.state == 0 or not fresh:
+        if self.state != 1 or not fresh:
             self.io.write(':OUTP{:d}:STAT ON'.format(self.channel))
+        self.state = 1
         return
 
+    @_batched
     def output_off(self, fresh=False):
-        if self.state == 1 or not fresh:
+        if self.state != 0 or not fresh:
             self.io.write(':OUTP{:d}:STAT OFF'.format(self.channel))
+        self.state = 0
         return
 
     def get_static_freq(self):
@@ -109,17 +474,19 @@ class _RigolDG4162InterfaceChannel(object):
     def get_static_amplitude(self):
         return self.io.query(':SOUR{:d}:VOLT?'.format(self.channel))
 
+    @_batched
     def static(self, freq, amplitude, fresh):
         if self.mode != 'static' or not fresh:
             # First attempt to disable sweep just changes front panel, need to send twice
-            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel))
-            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel))
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
             # First attempt to disable FM mod just changes front panel, need to send twice
-            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel))
-            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel))
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
 
             self.io.write(':OUTP{:d}:LOAD 50'.format(self.channel))
             self.io.write(':SOUR{:d}:FUNC:SHAP SIN'.format(self.channel))
+            self.io.write(':SOUR{:d}:BURS:STAT OFF'.format(self.channel))
             fresh = False
 
         if self.freq != freq or not fresh:
@@ -172,6 +539,7 @@ class _RigolDG4162InterfaceChannel(object):
     def get_sweep_steps(self):
         return self.io.query(':SOUR{:d}:SWE:STEP?'.format(self.channel))
 
+    @_batched
     def sweep(self, freq_start, freq_stop, amplitude,
               time, time_hold_start, time_hold_stop, time_return, spacing,
               trigger_slope, trigger_source, trigger_out, steps, fresh):
@@ -196,9 +564,10 @@ class _RigolDG4162InterfaceChannel(object):
         if self.mode != 'sweep' or not fresh:
             self.io.write(':OUTP{:d}:LOAD 50'.format(self.channel))
             self.io.write(':SOUR{:d}:FUNC:SHAP SIN'.format(self.channel))
+            self.io.write(':SOUR{:d}:BURS:STAT OFF'.format(self.channel))
             # First attempt to disable FM mod just changes front panel, need to send twice
-            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel))
-            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel))
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
 
             self.io.write(':SOUR{:d}:SWE:STAT ON'.format(self.channel))
             fresh = False
@@ -261,13 +630,15 @@ class _RigolDG4162InterfaceChannel(object):
     def get_fm_mod_mod_shape(self):
         return self.io.query(':SOUR{:d}:MOD:FM:INT:FUNC?'.format(self.channel))
 
+    @_batched
     def fm_mod(self, carrier_freq, mod_freq, amplitude, mod_amp, mod_source, mod_shape, fresh):
         if self.mode != 'fm_mod' or not fresh:
             self.io.write(':OUTP{:d}:LOAD 50'.format(self.channel))
             self.io.write(':SOUR{:d}:FUNC:SHAP SIN'.format(self.channel))
+            self.io.write(':SOUR{:d}:BURS:STAT OFF'.format(self.channel))
             # First attempt to disable sweep just changes front panel, need to send twice
-            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel))
-            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel))
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
 
             self.io.write(':SOUR{:d}:MOD:STAT ON'.format(self.channel))
             self.io.write(':SOUR{:d}:MOD:TYP FM'.format(self.channel))
@@ -302,13 +673,61 @@ class _RigolDG4162InterfaceChannel(object):
 
         return
 
+    @_batched
+    def arb(self, freq, amplitude, samples, waveform_hash, cycles, fresh):
+        '''Outputs an arbitrary waveform, repeated at freq. samples are the 14 bit DAC codes
+        of one period, which are only uploaded if waveform_hash differs from that of the
+        waveform last uploaded. If cycles, that many periods are output on each external
+        trigger (burst mode), otherwise the waveform repeats continuously.'''
+        if self.mode != 'arb' or not fresh:
+            # First attempt to disable sweep just changes front panel, need to send twice
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:SWE:STAT OFF'.format(self.channel), standalone=True)
+            # First attempt to disable FM mod just changes front panel, need to send twice
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
+            self.io.write(':SOUR{:d}:MOD:STAT OFF'.format(self.channel), standalone=True)
+
+            self.io.write(':OUTP{:d}:LOAD 50'.format(self.channel))
+            fresh = False
+        if self.waveform_hash != waveform_hash or not fresh:
+            # Little-endian 16 bit DAC codes, sent as binary rather than much longer ASCII
+            self.io.write_block(':SOUR{:d}:TRAC:DATA:DAC VOLATILE,'.format(self.channel),
+                                np.asarray(samples[()], dtype='<u2').tobytes())
+            self.io.write(':SOUR{:d}:FUNC:SHAP USER'.format(self.channel))
+        if self.freq != freq or not fresh:
+            self.io.write(':SOUR{:d}:FREQ {}'.format(self.channel, freq))
+        if self.amplitude != amplitude or not fresh:
+            self.io.write(':SOUR{:d}:VOLT:UNIT DBM'.format(self.channel))
+            self.io.write(':SOUR{:d}:VOLT {}'.format(self.channel, amplitude))
+            self.io.write(':SOUR{:d}:VOLT:OFFS 0'.format(self.channel))
+        if self.cycles != cycles or not fresh:
+            if cycles:
+                self.io.write(':SOUR{:d}:BURS:MODE TRIG'.format(self.channel))
+                self.io.write(':SOUR{:d}:BURS:NCYC {:d}'.format(self.channel, cycles))
+                self.io.write(':SOUR{:d}:BURS:TRIG:SOUR EXT'.format(self.channel))
+                self.io.write(':SOUR{:d}:BURS:TRIG:SLOP POS'.format(self.channel))
+                self.io.write(':SOUR{:d}:BURS:STAT ON'.format(self.channel))
+            else:
+                self.io.write(':SOUR{:d}:BURS:STAT OFF'.format(self.channel))
+
+        self._clear()
+        self.mode = 'arb'
+        self.freq = freq
+        self.amplitude = amplitude
+        self.cycles = cycles
+        self.waveform_hash = waveform_hash
+
+        return
+
 class RigolDG4162Interface(object):
-    def __init__(self, resource_str, access_mode):
+    def __init__(self, resource_str, access_mode, compound_commands=True, pacing='fixed'):
         self.access_mode = access_mode
-        self.io = _RigolIO(resource_str, access_mode)
+        self.io = _RigolIO(resource_str, access_mode, compound_commands, pacing)
 
         self.channels = [_RigolDG4162InterfaceChannel(1, self.io),
                          _RigolDG4162InterfaceChannel(2, self.io)]
+        # (time, commands written, channels, settings) of the last read_settings
+        self._readings = None
 
         return
 
@@ -320,6 +739,45 @@ class RigolDG4162Interface(object):
         assert channel in [1, 2], 'channel should be 1 or 2'
         return self.channels[channel-1].output_off(fresh)
 
+    def read_settings(self, channels=(1, 2), max_age=0):
+        '''Reads the settings of the channels back from the Rigol, as program_manual
+        takes them, with compound queries: one line for the mode of every channel,
+        then as few as possible for the settings of those modes.
+        Readings made less than max_age seconds ago are reused,
+        unless a command has been written since.
+        Returns a dict of the typed settings of each channel, keyed 'channel n'.'''
+        now = timer()
+        if (self._readings is not None and now - self._readings[0] < max_age
+                and self._readings[1] == self.io.n_written and self._readings[2] == tuple(channels)):
+            return self._readings[3]
+
+        chans = [self.channels[channel - 1] for channel in channels]
+        queries = [chan.mode_queries() for chan in chans]
+        replies = self.io.query_batch([query for chan_queries in queries for query in chan_queries])
+        modes = []
+        for chan, chan_queries in zip(chans, queries):
+            modes.append(chan.read_mode(replies[:len(chan_queries)]))
+            replies = replies[len(chan_queries):]
+
+        queries = []
+        for chan, (state, mode) in zip(chans, modes):
+            if state:
+                queries.extend((chan, name, query.format(chan.channel))
+                               for name, query in chan._setting_queries[mode])
+        replies = self.io.query_batch([query for _, _, query in queries])
+
+        settings = {}
+        for chan, (state, mode) in zip(chans, modes):
+            settings['channel {:d}'.format(chan.channel)] = {'state': state}
+            if state:
+                settings['channel {:d}'.format(chan.channel)]['mode'] = mode
+        for (chan, name, _), reply in zip(queries, replies):
+            settings['channel {:d}'.format(chan.channel)][name] = _parse_setting(
+                reply, chan._setting_types[name])
+
+        self._readings = (now, self.io.n_written, tuple(channels), settings)
+        return settings
+
     def get_state(self, channel):
         assert channel in [1, 2], 'channel should be 1 or 2'
         return self.channels[channel-1].get_state()
@@ -421,6 +879,44 @@ class RigolDG4162Interface(object):
         return self.channels[channel-1].fm_mod(carrier_freq, mod_freq, amplitude, mod_amp,
                                                mod_source, mod_shape, fresh)
 
+    def batch(self):
+        '''Context manager sending the commands written within as compound lines.'''
+        return self.io.batch()
+
+    def identify(self):
+        '''Returns the serial number of the Rigol, from its reply to *IDN?.'''
+        return self.io.query('*IDN?').split(',')[2].strip()
+
+    def get_cache(self):
+        '''Returns the settings last sent to each channel, as a dict which can be saved as JSON.'''
+        return {'channel {:d}'.format(channel.channel): channel.get_cache()
+                for channel in self.channels}
+
+    def restore_cache(self, cache):
+        '''Takes the settings last sent to each channel from a dict returned by get_cache,
+        keeping those of a channel only if reading them back from the Rigol,
+        with a single compound query, shows it still has them.
+        Returns the numbers of the channels whose settings were kept.'''
+        queries = []
+        for channel in self.channels:
+            channel.set_cache(cache.get('channel {:d}'.format(channel.channel), {}))
+            queries.append(channel.cache_queries())
+        replies = self.io.query_batch([query for channel_queries in queries
+                                       for query, _ in channel_queries])
+        restored = []
+        for channel, channel_queries in zip(self.channels, queries):
+            channel_replies, replies = replies[:len(channel_queries)], replies[len(channel_queries):]
+            if channel_queries and all(_setting_matches(reply, value) for reply, (_, value)
+                                       in zip(channel_replies, channel_queries)):
+                restored.append(channel.channel)
+            else:
+                channel.forget()
+        return restored
+
+    def arb(self, channel, freq, amplitude, samples, waveform_hash, cycles=0, fresh=False):
+        assert channel in [1, 2], 'channel should be 1 or 2'
+        return self.channels[channel-1].arb(freq, amplitude, samples, waveform_hash, cycles, fresh)
+
     def write(self, command):
         return self.io.write(command)
 
@@ -430,86 +926,89 @@ class RigolDG4162Interface(object):
     def close(self):
         return self.io.close()
 
+def _cache_path(serial):
+    '''Where the settings last sent to the Rigol with this serial number are saved.'''
+    return os.path.join(LabConfig().get('DEFAULT', 'app_saved_configs'), 'blacs',
+                        'RigolDG4162_{}.json'.format(serial))
+
 class Rigol4162Worker(Worker):
     def init(self):
-        self.rigol = RigolDG4162Interface(self.resource_str, self.access_mode)
+        self.rigol = RigolDG4162Interface(self.resource_str, self.access_mode,
+                                          self.compound_commands, self.pacing)
+        self.remote_value_max_age = 1 # s
+
+        # Settings last sent are saved per instrument, so that after a restart
+        # only those which have changed since need to be sent again
+        self.cache_path = _cache_path(self.rigol.identify())
+        try:
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = None
+        if cache is not None:
+            restored = self.rigol.restore_cache(cache)
+            self.logger.info('Rigol still has the saved settings of channels {}'.format(restored))
+
+    def _save_cache(self):
+        try:
+            with open(self.cache_path, 'w') as f:
+                json.dump(self.rigol.get_cache(), f, indent=4)
+        except OSError as e:
+            self.logger.warning('Could not save Rigol settings to {}: {}'.format(self.cache_path, e))
 
     def check_remote_values(self):
-        remove_values = {}
-        for channel in [1, 2]:
-            state = self.rigol.get_state(channel)
-            if state == 'OFF':
-                remote_values['channel {:d}'.format(channel)] = {'state': 0}
-                continue
-
-            mode = self.rigol.get_mode(channel)
-
-            if mode == 'static':
-                cv = {'state': 1, 'mode': 'static',
-                      'freq': self.rigol.get_static_freq(channel),
-                      'amplitude': self.rigol.get_static_amplitude(channel),}
-                remote_values['channel {:d}'.format(channel)] = cv
-            elif mode == 'sweep':
-                cv = {'state': 1, 'mode': 'sweep',
-                      'freq_start': self.rigol.get_sweep_freq_start(channel),
-                      'freq_2': self.rigol.get_sweep_freq_stop(channel),
-                      'amplitude': self.rigol.get_static_amplitude(channel),
-                      'time': self.rigol.get_sweep_time(channel),
-                      'time_hold_start': self.rigol.get_sweep_time_hold_start(channel),
-                      'time_hold_stop': self.rigol.get_sweep_time_hold_stop(channel),
-                      'time_return': self.rigol.get_sweep_time_return(channel),
-                      'spacing': self.rigol.get_sweep_spacing(channel),
-                      'steps': self.rigol.get_sweep_steps(channel),
-                      'trigger_slope': self.rigol.get_sweep_trigger_slope(channel),
-                      'trigger_source': self.rigol.get_sweep_trigger_source(channel),
-                      'trigger_out': self.rigol.get_sweep_trigger_out(channel)}
-                remote_values['channel {:d}'.format(channel)] = cv
-            elif mode == 'fm_mod':
-                cv = {'state': 1, 'mode': 'fm_mod',
-                      'freq': self.rigol.get_static_freq(channel),
-                      'freq_2': self.rigol.get_fm_mod_mod_freq(channel),
-                      'amplitude': self.rigol.get_static_amplitude(channel),
-                      'mod_amp': self.rigol.get_fm_mod_mod_amp(channel),
-                      'mod_source': self.rigol.get_fm_mod_mod_source(channel),
-                      'mod_shape': self.rigol.get_fm_mod_mod_shape(channel)}
-                remote_values['channel {:d}'.format(channel)] = cv
-            else:
-                remote_values['channel {:d}'.format(channel)] = {'state': 0}
-
-        return remote_values
+        # Repeated checks within this long reuse the readings, unless settings were sent since
+        return self.rigol.read_settings(max_age=self.remote_value_max_age)
 
     def program_manual(self, values):
-        for channel in [1, 2]:
-            key = 'channel {:d}'.format(channel)
-            if key in values.keys():
-                if values[key] is None:
-                    values[key] = {'state': False}
-            setting = values[key]
-
-            if not setting['state']:
-                self.rigol.output_off(channel)
-                continue
-
-            if setting['mode'] == 'static':
-                self.rigol.static(channel, setting['freq'], setting['amplitude'])
-            elif setting['mode'] == 'sweep':
-                self.rigol.sweep(channel, setting['freq'], setting['freq_2'],
-                                 setting['amplitude'], setting['time'],
-                                 setting['time_hold_start'], setting['time_hold_stop'],
-                                 setting['time_return'], setting['spacing'],
-                                 setting['trigger_slope'], setting['trigger_source'],
-                                 setting['trigger_out'], setting['steps'])
-            elif setting['mode'] == 'fm_mod':
-                self.rigol.fm_mod(channel, setting['freq'], setting['freq_2'],
-                                  setting['amplitude'], setting['mod_amp'],
-                                  setting['mod_source'], setting['mod_shape'])
-            else:
-                print('Invalid mode')
+        # Only send the settings which have changed
+        self._program(values, only_changed=True)
+        return
 
-            self.rigol.output_on(channel)
+    def _program(self, values, only_changed):
+        '''Programs both channels. If only_changed, only settings which differ from
+        those last sent are sent, otherwise all of them are.'''
+        # Both channels are programmed with as few compound lines as possible
+        with self.rigol.batch():
+            for channel in [1, 2]:
+                key = 'channel {:d}'.format(channel)
+                if key in values.keys():
+                    if values[key] is None:
+                        values[key] = {'state': False}
+                setting = values[key]
+
+                if not setting['state']:
+                    self.rigol.output_off(channel, fresh=only_changed)
+                    continue
+
+                if setting['mode'] == 'static':
+                    self.rigol.static(channel, setting['freq'], setting['amplitude'],
+                                      fresh=only_changed)
+                elif setting['mode'] == 'sweep':
+                    self.rigol.sweep(channel, setting['freq'], setting['freq_2'],
+                                     setting['amplitude'], setting['time'],
+                                     setting['time_hold_start'], setting['time_hold_stop'],
+                                     setting['time_return'], setting['spacing'],
+                                     setting['trigger_slope'], setting['trigger_source'],
+                                     setting['trigger_out'], setting['steps'],
+                                     fresh=only_changed)
+                elif setting['mode'] == 'fm_mod':
+                    self.rigol.fm_mod(channel, setting['freq'], setting['freq_2'],
+                                      setting['amplitude'], setting['mod_amp'],
+                                      setting['mod_source'], setting['mod_shape'],
+                                      fresh=only_changed)
+                elif setting['mode'] == 'arb':
+                    self.rigol.arb(channel, setting['freq'], setting['amplitude'],
+                                   setting['samples'], setting['waveform_hash'],
+                                   setting['cycles'], fresh=only_changed)
+                else:
+                    print('Invalid mode')
+
+                self.rigol.output_on(channel, fresh=only_changed)
+        self._save_cache()
         return
 
-    def _parse_channel_dataset(self, dataset):
+    def _parse_channel_dataset(self, dataset, waveform=None):
         state = dataset['state'][0]
         if not state:
             return {'state': 0}
@@ -540,6 +1039,14 @@ class Rigol4162Worker(Worker):
                     'mod_amp': dataset['mod_amp'][0],
                     'mod_source': dataset['mod_source'][0].decode(),
                     'mod_shape': dataset['mod_shape'][0].decode()}
+        elif mode == 'arb':
+            # The samples are only read if the waveform differs from the one last uploaded
+            return {'state': 1, 'mode': 'arb',
+                    'freq': dataset['freq'][0],
+                    'amplitude': dataset['amplitude'][0],
+                    'cycles': int(dataset['cycles'][0]),
+                    'samples': waveform,
+                    'waveform_hash': waveform.attrs['hash']}
         else:
             return {'state': 0}
 
@@ -547,15 +1054,17 @@ class Rigol4162Worker(Worker):
         with h5py.File(h5file, 'r') as hdf5_file:
             group = hdf5_file['/devices/' + device_name]
             values = {}
-            if 'channel 1' in group:
-                values['channel 1'] = self._parse_channel_dataset(group['channel 1'])
-            else:
-                values['channel 1'] = {'state': False}
-            if 'channel 2' in group:
-                values['channel 2'] = self._parse_channel_dataset(group['channel 2'])
-            else:
-                values['channel 2'] = {'state': False}
-        self.program_manual(values)
+            for channel in [1, 2]:
+                key = 'channel {:d}'.format(channel)
+                if key in group:
+                    values[key] = self._parse_channel_dataset(group[key],
+                                                              group.get(key + ' waveform'))
+                else:
+                    values[key] = {'state': False}
+            # BLACS asks for a fresh program when its smart programming cache is cleared,
+            # which is when the cache of settings last sent should not be trusted either.
+            # Programmed with the file open, as waveform samples are read from it
+            self._program(values, only_changed=not fresh)
         return {}
 
     def transition_to_manual(self):
@@ -1,8 +1,9 @@
 from user_devices.RigolAWG.rigol_awg_enums import *
 from user_devices.RigolAWG.labscript_devices import RigolDG4162
+import numpy as np
 
 trigger_device = None # TODO: setup a trigger
-RigolDG4162(name='test_rf', channel_1_trigger=trigger_device, channel_2_trigger=None,
+RigolDG4162(name='test_rf', channel_1_trigger=trigger_device, channel_2_trigger=trigger_device,
             resource_str='USB0::0x1AB1::0x0641::DG4E160800425::INSTR', access_mode='usb')
 
 start()
@@ -11,6 +12,10 @@ t = 0
 t = t + 0.1
 
 test_rf.channel_1.sweep_output(t, 1.0, 2000., 10000., 0.01)
+# Two frequency segments as an arbitrary waveform repeating every 40 us:
+# 250 kHz for 20 us, then 500 kHz for 20 us, with the phase continuous between them
+cycles_done = lambda phase: np.where(phase < 0.5, 10 * phase, 5 + 20 * (phase - 0.5))
+test_rf.channel_2.arb_output(t, 1.0, 25e3, lambda phase: np.sin(2 * np.pi * cycles_done(phase)))
 
 t = t + 0.2
 
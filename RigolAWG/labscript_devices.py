@@ -1,7 +1,30 @@
 from labscript import IntermediateDevice, DigitalOut, LabscriptError, set_passed_properties, StaticAnalogQuantity, StaticDigitalQuantity, TriggerableDevice
 from user_devices.RigolAWG.rigol_awg_enums import *
+import hashlib
 import numpy as np
 
+max_arb_samples = 16384 # Samples of one period of an arbitrary waveform
+dac_max = 16383 # 14 bit DAC code of the maximum output, the minimum being 0
+
+def compile_waveform(waveform, n_samples):
+    '''Returns the DAC codes of one period of an arbitrary waveform, as int16.
+
+    Args:
+    waveform: Function of the phase (0 <= phase < 1, an array) returning the output,
+              or the output at equally spaced phases. The output spans -1 to 1.
+    n_samples: Number of samples, if waveform is a function.
+    '''
+    if callable(waveform):
+        values = waveform(np.arange(n_samples) / n_samples)
+    else:
+        values = waveform
+    values = np.asarray(values, dtype=float)
+    if values.ndim != 1 or not 2 <= len(values) <= max_arb_samples:
+        raise LabscriptError('Arbitrary waveform must have between 2 and %d samples' % max_arb_samples)
+    if not np.all(np.abs(values) <= 1):
+        raise LabscriptError('Arbitrary waveform must lie between -1 and 1')
+    return np.round((values + 1) * dac_max / 2).astype(np.int16)
+
 class RigolDG4162Channel(TriggerableDevice):
     description = 'Rigol DG4162 arbitrary waveform generator channel'
 
@@ -30,6 +53,8 @@ class RigolDG4162Channel(TriggerableDevice):
         self.trigger_out = 'OFF'
         self.mod_source = 'INT'
         self.mod_shape = 'SIN'
+        self.cycles = 0
+        self.waveform = None
 
         self.setup = False
 
@@ -78,6 +103,33 @@ class RigolDG4162Channel(TriggerableDevice):
 
         self.setup = True
 
+    def arb_output(self, t, amp, freq, waveform, cycles=1, n_samples=max_arb_samples, trigger=True):
+        '''Outputs an arbitrary waveform, each period of which lasts 1/freq.
+
+        Args:
+        t: Time of the trigger.
+        amp: Amplitude, dBm.
+        freq: Repetition frequency of the waveform, Hz.
+        waveform: Function of the phase (0 <= phase < 1, an array) returning the output,
+                  or the output at equally spaced phases. The output spans -1 to 1.
+        cycles: Periods output after the trigger, or 0 to output the waveform continuously.
+        n_samples: Number of samples, if waveform is a function.
+        trigger: Whether to trigger the channel at t, if outputting a number of cycles.
+        '''
+        if self.setup:
+            raise LabscriptError('%s has already been setup. It can only have one output per run.' % self.name)
+        self.state = 1
+        self.mode = 'arb'
+        self.freq = freq
+        self.amplitude = amp
+        self.cycles = cycles
+        self.waveform = compile_waveform(waveform, n_samples)
+
+        if trigger and cycles:
+            self.parent_device.trigger(t, 1e-4)
+
+        self.setup = True
+
     def generate_code(self, hdf5_file):
         pass
 
@@ -91,22 +143,29 @@ class RigolDG4162(IntermediateDevice):
           access_mode: 'eth' or 'usb'
           frequency_limits: minimum and maximum output frequency
           amplitude_limits: minimum and maximum output amplitude
+          compound_commands: send the commands programming a channel joined into
+                             compound SCPI lines, rather than one command per line
+          pacing: over Ethernet, 'fixed' waits 20 ms after each line sent,
+                  'opc' waits for the Rigol to report completion with *OPC?
     """
     description = 'Rigol DG4162 arbitrary waveform generator'
 
     @set_passed_properties(
         property_names = {
             'connection_table_properties': ['termination', 'resource_str', 'access_mode',
-                                            'frequency_limits', 'amplitude_limits'],
+                                            'frequency_limits', 'amplitude_limits',
+                                            'compound_commands', 'pacing'],
         }
     )
     def __init__(self, name, channel_1_trigger, channel_2_trigger,
                  termination='\n', resource_str=None, access_mode=None,
-                 frequency_limits=None, amplitude_limits=None, timeout=5, **kwargs):
+                 frequency_limits=None, amplitude_limits=None, timeout=5,
+                 compound_commands=True, pacing='fixed', **kwargs):
         IntermediateDevice.__init__(self, name, None, **kwargs)
 
         self.name = name
         assert access_mode in ['eth', 'usb'], "Access mode must be one of 'eth' (Ethernet) or 'usb' (USB)"
+        assert pacing in ['fixed', 'opc'], "Pacing must be one of 'fixed' or 'opc'"
         self.BLACS_connection = access_mode + ',' + resource_str
         self.termination = termination
 
@@ -143,6 +202,7 @@ class RigolDG4162(IntermediateDevice):
                                     ('trigger_out', '<S3'),
                                     ('mod_source', '<S5'),
                                     ('mod_shape', '<S5'),
+                                    ('cycles', int),
                                     ])
         params['state'] = channel.state
         params['mode'] = channel.mode
@@ -161,13 +221,19 @@ class RigolDG4162(IntermediateDevice):
         params['trigger_out'] = channel.trigger_out
         params['mod_source'] = channel.mod_source
         params['mod_shape'] = channel.mod_shape
+        params['cycles'] = channel.cycles
 
         return params
 
     def generate_code(self, hdf5_file):
         IntermediateDevice.generate_code(self, hdf5_file)
         group = self.init_device_group(hdf5_file)
-        if self.channel_1:
-            group.create_dataset('channel 1', data=self.get_channel_params(self.channel_1))
-        if self.channel_2:
-            group.create_dataset('channel 2', data=self.get_channel_params(self.channel_2))
+        for channel in [self.channel_1, self.channel_2]:
+            if not channel:
+                continue
+            key = 'channel %d' % channel.channel
+            group.create_dataset(key, data=self.get_channel_params(channel))
+            if channel.waveform is not None:
+                # The hash lets BLACS skip uploading a waveform the Rigol already has
+                dataset = group.create_dataset(key + ' waveform', data=channel.waveform)
+                dataset.attrs['hash'] = hashlib.sha1(channel.waveform.tobytes()).hexdigest()
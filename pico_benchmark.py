@@ -0,0 +1,133 @@
+'''Benchmarks table uploads of the Pi Pico based devices against the stand-in firmware
+in pico_simulator.py, so regressions in the serial hot path can be caught without hardware
+(Linux/macOS only).
+
+For each upload path, times uploading tables of increasing length
+and prints the time taken and the throughput:
+
+    python -m user_devices.pico_benchmark
+    python -m user_devices.pico_benchmark --byte-time 1e-7 --command-time 1e-4 --sizes 100 10000
+    python -m user_devices.pico_benchmark --port COM5 --case PrawnDO
+
+The latency options model the link and firmware (see PicoSimulator).
+Without them, the times include only the host side and the simulator itself.
+With --port, the cases run against the device on that serial port instead,
+so only the cases of that device (and the encodings its firmware supports) should be chosen.
+'''
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+
+from user_devices.pico_simulator import AD9914PicoSimulator, PrawnDOSimulator
+from user_devices.AD9914_pico.blacs_workers import AD9914PicoInterface
+from user_devices.AD9914_pico import ad9914_protocol
+from user_devices.prawn_do.blacs_workers import PrawnDOInterface
+from user_devices.prawn_do import prawn_do_protocol
+
+def dds_table(n_rows):
+    '''A dds_data table of linear sweeps, triggered every 100 rows.'''
+    commands = np.zeros(n_rows, dtype=ad9914_protocol.dds_data_dtype)
+    commands['start freq'] = np.linspace(1e8, 2e8, n_rows)
+    commands['stop freq'] = commands['start freq'] + 1e3
+    commands['start amp'] = 0.5
+    commands['stop amp'] = 0.6
+    commands['sweep'] = True
+    commands['sweep time'] = 1e-5
+    commands['trigger'] = np.arange(n_rows) % 100 == 0
+    return commands
+
+def do_table(n_rows):
+    '''A PrawnDO table with one line toggling every row and the rest every 100 rows.'''
+    rows = np.arange(n_rows)
+    return ((rows % 2) | ((rows // 100 % 2) * 0xfffe)).astype(np.uint16)
+
+def add_batch_per_row(intf, bit_sets):
+    '''PrawnDOInterface.add_batch as it used to be, writing each row separately.'''
+    intf.conn.write('add\n'.encode())
+    for bit_set in bit_sets.tolist():
+        intf.conn.write('0x{:04x}\n'.format(bit_set).encode())
+    intf.conn.write('end\n'.encode())
+    return intf.conn.read_until(b'> ')
+
+def ad9914_case(capabilities, binary=True, quantize=False):
+    def run(n_rows, latency, port=None):
+        simulator = None
+        if port is None:
+            simulator = AD9914PicoSimulator(capacity=n_rows, capabilities=capabilities, **latency)
+            port = simulator.port
+        intf = AD9914PicoInterface(port, binary=binary)
+        intf.conn.timeout = 60
+        commands = dds_table(n_rows)
+        if quantize:
+            commands = ad9914_protocol.quantize(commands, 3.5e9)
+        intf.clear()
+        t_start = timer()
+        intf.add_batch(commands)
+        duration = timer() - t_start
+        n_bytes = intf.upload_stats['bytes']
+        intf.clear()
+        intf.close()
+        if simulator is not None:
+            simulator.close()
+        return duration, n_bytes
+    return run
+
+def prawn_do_case(capabilities, upload, rle=False):
+    def run(n_rows, latency, port=None):
+        simulator = None
+        if port is None:
+            simulator = PrawnDOSimulator(capabilities=capabilities, **latency)
+            port = simulator.port
+        intf = PrawnDOInterface(port)
+        intf.conn.timeout = 60
+        table = np.append(0, do_table(n_rows)).astype(np.uint16)
+        if rle:
+            table = prawn_do_protocol.run_length_encode(table)
+            n_bytes = len(prawn_do_protocol.encode_rle(table))
+        else:
+            n_bytes = len(prawn_do_protocol.encode_payload(table)[1])
+        intf.clear()
+        t_start = timer()
+        upload(intf, table)
+        duration = timer() - t_start
+        intf.clear()
+        intf.close()
+        if simulator is not None:
+            simulator.close()
+        return duration, n_bytes
+    return run
+
+cases = [
+    ('AD9914 text add', ad9914_case((), binary=False)),
+    ('AD9914 binary addb', ad9914_case(('bin',))),
+    ('AD9914 integer addi', ad9914_case(('bin', 'int'), quantize=True)),
+    ('PrawnDO add, per row', prawn_do_case((), add_batch_per_row)),
+    ('PrawnDO add', prawn_do_case((), PrawnDOInterface.add_batch)),
+    ('PrawnDO rle addr', prawn_do_case(('rle',), PrawnDOInterface.add_rle, rle=True)),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark Pico table uploads against the simulator')
+    parser.add_argument('--byte-time', type=float, default=0,
+                        help='modelled time to receive each byte, s')
+    parser.add_argument('--command-time', type=float, default=0,
+                        help='modelled time to handle each command, s')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='table lengths to upload')
+    parser.add_argument('--case', default='',
+                        help='only run cases whose name contains this')
+    parser.add_argument('--port', default=None,
+                        help='serial port of a device to run the cases against, instead of the simulator')
+    args = parser.parse_args()
+    latency = {'byte_time': args.byte_time, 'command_time': args.command_time}
+
+    print('{:<24} {:>8} {:>10} {:>12} {:>10}'.format('case', 'rows', 'time (s)', 'rows/s', 'MB/s'))
+    for name, run in cases:
+        if args.case not in name:
+            continue
+        for n_rows in args.sizes:
+            duration, n_bytes = run(n_rows, latency, args.port)
+            print('{:<24} {:8d} {:10.4f} {:12.0f} {:10.2f}'.format(name, n_rows, duration,
+                                                                 n_rows / duration,
+                                                                 n_bytes / duration / 1e6))
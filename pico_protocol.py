@@ -0,0 +1,24 @@
+'''Parts of the serial protocol shared by the firmware of the Pi Pico based devices.'''
+
+def is_error(reply):
+    '''Whether a reply from the Pico reports a failed command.'''
+    reply = reply.lower()
+    return b'error' in reply or b'invalid' in reply
+
+def query(conn, command):
+    '''Sends a command which replies with a line '<command>:<value>'.
+    Returns the value as a string, or None if the reply has no such line.'''
+    conn.write(command + b'\n')
+    resp = conn.read_until(b'> ')
+    for line in resp.splitlines():
+        if line.startswith(command + b':'):
+            return line[len(command) + 1:].decode().strip()
+    return None
+
+def get_capabilities(conn):
+    '''Sends 'cap' command, which lists the optional protocol features of the firmware.
+    Returns a set of feature names, which is empty for firmware without the command.'''
+    value = query(conn, b'cap')
+    if value is None:
+        return set()
+    return set(value.split())
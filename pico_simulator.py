@@ -0,0 +1,427 @@
+'''Stand-in firmware for the Pi Pico based devices, served on a pseudo-terminal.
+
+This lets the BLACS workers and interfaces be exercised without hardware (Linux/macOS only).
+Create a simulator and pass its port to the interface as the com_port, e.g.
+
+    sim = AD9914PicoSimulator()
+    intf = AD9914PicoInterface(sim.port)
+
+or run this module to serve one until interrupted:
+
+    python -m user_devices.pico_simulator ad9914
+'''
+import os
+import pty
+import threading
+import tty
+import zlib
+from time import sleep
+from timeit import default_timer as timer
+
+import numpy as np
+
+from user_devices.AD9914_pico import ad9914_protocol
+from user_devices.prawn_do import prawn_do_protocol
+
+class PicoSimulator(object):
+    '''Serves a line based command protocol on a pseudo-terminal.
+    Subclasses implement commands as do_<name>(self, args) methods,
+    which return the reply text (without the prompt).
+
+    Latency is modelled by taking byte_time seconds to receive each byte
+    and command_time seconds to handle each command, on top of the time
+    the simulator itself takes.'''
+    prompt = b'> '
+
+    def __init__(self, byte_time=0, command_time=0):
+        self.master, self.slave = pty.openpty()
+        # Raw mode, so binary payloads and line endings pass through untouched
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+
+        self.byte_time = byte_time
+        self.command_time = command_time
+        self._ready = timer() # When the modelled latency so far will have passed
+
+        self.commands_received = 0
+        self._buffer = bytearray()
+        self._binary_handler = None # (number of bytes, function) while reading a binary payload
+        self._line_handler = None # function while reading lines of data
+        self._closed = False
+        self.lock = threading.Lock() # Held while handling a command
+
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                return
+            self._delay(len(data) * self.byte_time)
+            self._buffer += data
+            self._process()
+
+    def _delay(self, duration):
+        '''Adds duration to the modelled latency, sleeping once it adds up to a millisecond
+        or more, since shorter sleeps are not accurate.'''
+        if duration <= 0:
+            return
+        now = timer()
+        self._ready = max(self._ready, now) + duration
+        if self._ready - now >= 1e-3:
+            sleep(self._ready - now)
+
+    def _process(self):
+        while True:
+            if self._binary_handler is not None:
+                n_bytes, function = self._binary_handler
+                if len(self._buffer) < n_bytes:
+                    return
+                payload = bytes(self._buffer[:n_bytes])
+                del self._buffer[:n_bytes]
+                self._binary_handler = None
+                with self.lock:
+                    self._reply(self._call(function, payload))
+                continue
+
+            end = self._buffer.find(b'\n')
+            if end < 0:
+                return
+            line = bytes(self._buffer[:end]).strip().decode(errors='replace')
+            del self._buffer[:end + 1]
+            if not line:
+                continue
+
+            if self._line_handler is not None:
+                with self.lock:
+                    reply = self._call(self._line_handler, line)
+                    if reply is not None:
+                        self._line_handler = None
+                        self._reply(reply)
+                continue
+
+            self.commands_received += 1
+            self._delay(self.command_time)
+            name, _, args = line.partition(':')
+            handler = getattr(self, 'do_' + name, None)
+            with self.lock:
+                if handler is None:
+                    self._reply('Error: unknown command {}'.format(name))
+                    continue
+                reply = self._call(handler, args)
+                # Handlers expecting more data reply once it has arrived
+                if self._binary_handler is None and self._line_handler is None:
+                    self._reply(reply)
+
+    def _call(self, function, argument):
+        try:
+            return function(argument)
+        except Exception as e:
+            self._line_handler = None
+            return 'Error: {}'.format(e)
+
+    def read_binary(self, n_bytes, function):
+        '''Called by a handler to read n_bytes of binary payload after its command line.
+        function is called with the payload and returns the reply.'''
+        self._binary_handler = (n_bytes, function)
+
+    def read_lines(self, function):
+        '''Called by a handler to read lines of data after its command line.
+        function is called with each line, and returns None to read another
+        or the reply once the data is complete.'''
+        self._line_handler = function
+
+    def _reply(self, text):
+        if text:
+            self.write(text.encode() + b'\r\n')
+        self.write(self.prompt)
+
+    def write(self, data):
+        os.write(self.master, data)
+
+    def close(self):
+        self._closed = True
+        os.close(self.slave)
+        os.close(self.master)
+
+class AD9914PicoSimulator(PicoSimulator):
+    '''Stand-in for the AD9914 Pico firmware.
+
+    The table is kept as a list of binary records (ad9914_protocol.binary_record_dtype,
+    or integer_record_dtype for 'addi' uploads). During a streamed run,
+    entries are played (and freed) one every entry_period seconds.
+    output holds the (frequency, amplitude) last output by 'run' or 'set'.'''
+    def __init__(self, capacity=4096, capabilities=('bin', 'int', 'stream', 'crc', 'set'),
+                 entry_period=1e-4, **kwargs):
+        self.capacity = capacity
+        self.capabilities = set(capabilities)
+        self.entry_period = entry_period
+
+        self.table = []
+        self.integer_table = False
+        self.running = False
+        self.streaming = False
+        self.finished = False
+        self.played = 0
+        self.underrun = False
+        self._player = None
+        self.output = None
+
+        PicoSimulator.__init__(self, **kwargs)
+
+    def do_cap(self, args):
+        return 'cap: ' + ' '.join(sorted(self.capabilities))
+
+    def do_cls(self, args):
+        self.table = []
+        self.integer_table = False
+        self.streaming = False
+        self.finished = False
+        self.played = 0
+        self.underrun = False
+        return ''
+
+    def do_abt(self, args):
+        self.running = False
+        return ''
+
+    def do_run(self, args):
+        self.running = True
+        if self.table and not self.integer_table:
+            record = np.frombuffer(self.table[0], dtype=ad9914_protocol.binary_record_dtype)[0]
+            self.output = (record['start freq'], record['start amp'])
+        if self.streaming:
+            self._player = threading.Thread(target=self._play, daemon=True)
+            self._player.start()
+        return ''
+
+    def do_set(self, args):
+        if 'set' not in self.capabilities:
+            return 'Error: unknown command set'
+        freq, amp = [float(value) for value in args.split(',')]
+        # As abt, cls, add:cst,<freq>,cst,<amp>,0 and run
+        self.do_abt('')
+        self.do_cls('')
+        self.do_add('cst,{:e},cst,{:e},0'.format(freq, amp))
+        self.running = True
+        self.output = (freq, amp)
+        return ''
+
+    def do_dmp(self, args):
+        lines = []
+        dtype = (ad9914_protocol.integer_record_dtype if self.integer_table
+                 else ad9914_protocol.binary_record_dtype)
+        for record in np.frombuffer(b''.join(self.table), dtype=dtype):
+            lines.append(','.join(str(value) for value in record.tolist()))
+        return '\r\n'.join(lines)
+
+    def do_add(self, args):
+        self._require_space(1)
+        fields = args.split(',')
+        if fields[0] == 'cst':
+            start_freq = stop_freq = float(fields[1])
+            fields = fields[2:]
+        else:
+            start_freq, stop_freq = float(fields[1]), float(fields[2])
+            fields = fields[3:]
+        if fields[0] == 'cst':
+            start_amp = stop_amp = float(fields[1])
+            fields = fields[2:]
+        else:
+            start_amp, stop_amp = float(fields[1]), float(fields[2])
+            fields = fields[3:]
+        if len(fields) == 2:
+            sweep_time, trigger = float(fields[0]), float(fields[1])
+            flags = ad9914_protocol.FLAG_SWEEP
+        else:
+            sweep_time, trigger = 0., float(fields[0])
+            flags = 0
+        if trigger:
+            flags |= ad9914_protocol.FLAG_TRIGGER
+        record = np.array([(start_freq, stop_freq, start_amp, stop_amp, sweep_time, flags)],
+                          dtype=ad9914_protocol.binary_record_dtype)
+        self.table.append(record.tobytes())
+        return ''
+
+    def do_addb(self, args):
+        return self._add_records(args, ad9914_protocol.binary_record_dtype, False)
+
+    def do_addi(self, args):
+        if 'int' not in self.capabilities:
+            return 'Error: unknown command addi'
+        return self._add_records(args, ad9914_protocol.integer_record_dtype, True)
+
+    def _add_records(self, args, dtype, integer):
+        count, size = [int(value) for value in args.split(',')]
+        if size != dtype.itemsize:
+            return 'Error: invalid record size {:d}'.format(size)
+        terminator = ad9914_protocol.binary_terminator
+
+        def receive(payload):
+            if not payload.endswith(terminator):
+                return 'Error: missing terminator'
+            self._require_space(count)
+            self.integer_table = integer
+            records = payload[:-len(terminator)]
+            self.table.extend(records[i:i + size] for i in range(0, len(records), size))
+            return ''
+        self.read_binary(count * size + len(terminator), receive)
+        return ''
+
+    def do_crc(self, args):
+        if 'crc' not in self.capabilities:
+            return 'Error: unknown command crc'
+        return 'crc:{:08x}'.format(zlib.crc32(b''.join(self.table)) & 0xffffffff)
+
+    def do_fre(self, args):
+        return 'fre:{:d}'.format(self.capacity - len(self.table))
+
+    def do_str(self, args):
+        self.streaming = True
+        self.finished = False
+        return ''
+
+    def do_fin(self, args):
+        self.finished = True
+        return ''
+
+    def _require_space(self, count):
+        if len(self.table) + count > self.capacity:
+            raise RuntimeError('table full')
+
+    def _play(self):
+        '''Plays a streamed run, freeing each entry once it has been output.'''
+        while self.running:
+            sleep(self.entry_period)
+            with self.lock:
+                if self.table:
+                    self.table.pop(0)
+                    self.played += 1
+                elif self.finished:
+                    self.running = False
+                else:
+                    self.underrun = True
+                    self.running = False
+
+class PrawnDOSimulator(PicoSimulator):
+    '''Stand-in for the PrawnDO firmware.
+    The table is kept as a list of rows, each the state of the 16 outputs,
+    or of (bits, repeat) entries after an 'addr' upload.
+    output holds the state last output by 'run' or 'set'.'''
+    def __init__(self, capabilities=('crc', 'rle', 'ovr', 'set'), **kwargs):
+        self.capabilities = set(capabilities)
+        self.table = []
+        self.rle = False
+        self.running = False
+        self.output = None
+
+        PicoSimulator.__init__(self, **kwargs)
+
+    def do_cap(self, args):
+        if not self.capabilities:
+            return 'Error: unknown command cap'
+        return 'cap: ' + ' '.join(sorted(self.capabilities))
+
+    def do_cls(self, args):
+        self.table = []
+        self.rle = False
+        return ''
+
+    def do_abt(self, args):
+        self.running = False
+        return ''
+
+    def do_run(self, args):
+        self.running = True
+        if self.table:
+            # The first row is output immediately
+            self.output = self.table[0][0] if self.rle else self.table[0]
+        return ''
+
+    def do_set(self, args):
+        if 'set' not in self.capabilities:
+            return 'Error: unknown command set'
+        # As abt, cls, add with the single row and run
+        self.do_abt('')
+        self.do_cls('')
+        self.table.append(int(args, 16) & 0xffff)
+        return self.do_run('')
+
+    def do_dmp(self, args):
+        if self.rle:
+            return '\r\n'.join('0x{:04x},{:d}'.format(*entry) for entry in self.table)
+        return '\r\n'.join('0x{:04x}'.format(row) for row in self.table)
+
+    def do_add(self, args):
+        if self.rle and self.table:
+            return 'Error: table is run length encoded'
+        def receive(line):
+            if line == 'end':
+                return ''
+            self.table.append(int(line, 16) & 0xffff)
+        self.read_lines(receive)
+        return ''
+
+    def do_addr(self, args):
+        if 'rle' not in self.capabilities:
+            return 'Error: unknown command addr'
+        if self.table and not self.rle:
+            return 'Error: table is not run length encoded'
+        count, size = [int(value) for value in args.split(',')]
+        if size != prawn_do_protocol.rle_dtype.itemsize:
+            return 'Error: invalid record size {:d}'.format(size)
+        terminator = prawn_do_protocol.binary_terminator
+
+        def receive(payload):
+            if not payload.endswith(terminator):
+                return 'Error: missing terminator'
+            entries = np.frombuffer(payload[:-len(terminator)], dtype=prawn_do_protocol.rle_dtype)
+            if np.any(entries['repeat'] == 0):
+                return 'Error: invalid repeat count 0'
+            self.rle = True
+            self.table.extend(entries.tolist())
+            return ''
+        self.read_binary(count * size + len(terminator), receive)
+        return ''
+
+    def do_ovr(self, args):
+        if 'ovr' not in self.capabilities:
+            return 'Error: unknown command ovr'
+        start, count, size = [int(value) for value in args.split(',')]
+        dtype = prawn_do_protocol.rle_dtype if self.rle else prawn_do_protocol.table_dtype
+        if size != dtype.itemsize:
+            return 'Error: invalid record size {:d}'.format(size)
+        terminator = prawn_do_protocol.binary_terminator
+
+        def receive(payload):
+            if start < 0 or start + count > len(self.table):
+                return 'Error: invalid range {:d}-{:d}'.format(start, start + count)
+            if not payload.endswith(terminator):
+                return 'Error: missing terminator'
+            entries = np.frombuffer(payload[:-len(terminator)], dtype=dtype)
+            self.table[start:start + count] = entries.tolist()
+            return ''
+        self.read_binary(count * size + len(terminator), receive)
+        return ''
+
+    def do_crc(self, args):
+        if 'crc' not in self.capabilities:
+            return 'Error: unknown command crc'
+        if self.rle:
+            table = np.array(self.table, dtype=prawn_do_protocol.rle_dtype)
+        else:
+            table = self.table
+        return 'crc:{:08x}'.format(prawn_do_protocol.checksum(table))
+
+if __name__ == '__main__':
+    import sys
+    simulators = {'ad9914': AD9914PicoSimulator, 'prawn_do': PrawnDOSimulator}
+    simulator = simulators[sys.argv[1] if len(sys.argv) > 1 else 'ad9914']()
+    print('Serving {} on {}'.format(type(simulator).__name__, simulator.port))
+    try:
+        while True:
+            sleep(1)
+    except KeyboardInterrupt:
+        simulator.close()
@@ -0,0 +1,99 @@
+'''Chunked uploads of tables to the Pi Pico based devices.
+
+A table is read (e.g. from an h5py dataset of the shot file) and encoded a chunk at a time,
+and each encoded chunk is handed over a bounded queue to a thread writing it to the serial port.
+Reading, encoding and writing then overlap, so uploading a large table takes little longer
+than the serial transfer alone. Unless the rows read are kept (e.g. to verify the upload),
+only a few chunks are held in memory at once.
+'''
+import queue
+import threading
+
+import numpy as np
+
+chunk_bytes = 1 << 16 # Size of the chunks read from the table
+max_queued = 4 # Encoded chunks waiting to be written before reading blocks
+
+class Concatenated(object):
+    '''Tables (arrays or h5py datasets) of the same dtype joined end to end,
+    read only when sliced, e.g. to send an initial row before the rows of a dataset.'''
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.dtype = np.dtype(self.parts[0].dtype)
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __getitem__(self, item):
+        start, stop, _ = item.indices(len(self))
+        chunks = []
+        offset = 0
+        for part in self.parts:
+            if start < offset + len(part) and stop > offset:
+                chunks.append(part[max(start - offset, 0):min(stop - offset, len(part))])
+            offset += len(part)
+        if not chunks:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(chunks).astype(self.dtype, copy=False)
+
+class _Writer(threading.Thread):
+    '''Writes the chunks put on its queue to conn until it gets None.'''
+    def __init__(self, conn):
+        threading.Thread.__init__(self, daemon=True)
+        self.conn = conn
+        self.queue = queue.Queue(max_queued)
+        self.error = None
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            # After an error keep taking chunks, so the reading side never blocks
+            if self.error is None:
+                try:
+                    self.conn.write(data)
+                except Exception as e:
+                    self.error = e
+
+def write_chunked(conn, table, encode, header=b'', terminator=b'', keep_rows=True):
+    '''Writes header, the encoding of each chunk of table and terminator to conn.
+    Chunks are read and encoded in this thread while earlier ones are written from another.
+
+    Args:
+    conn: The serial port.
+    table: Array, h5py dataset or Concatenated to upload.
+    encode: Function returning the bytes to send for a chunk of table.
+    header, terminator: Bytes sent before and after the table.
+    keep_rows: Whether to keep the rows read, which otherwise are dropped once encoded.
+
+    Returns (rows, n_bytes): the rows of table which were read, as an array
+    (None unless keep_rows), and the number of bytes written.
+    Throws the exception of the write if one failed.'''
+    rows_per_chunk = max(1, chunk_bytes // np.dtype(table.dtype).itemsize)
+    writer = _Writer(conn)
+    writer.start()
+    chunks = []
+    n_bytes = len(header) + len(terminator)
+    try:
+        writer.queue.put(header)
+        for start in range(0, len(table), rows_per_chunk):
+            if writer.error is not None:
+                break
+            chunk = table[start:start + rows_per_chunk]
+            data = encode(chunk)
+            writer.queue.put(data)
+            if keep_rows:
+                chunks.append(chunk)
+            n_bytes += len(data)
+        writer.queue.put(terminator)
+    finally:
+        writer.queue.put(None)
+        writer.join()
+    if writer.error is not None:
+        raise writer.error
+    if not keep_rows:
+        return None, n_bytes
+    if not chunks:
+        return np.empty(0, dtype=table.dtype), n_bytes
+    return np.concatenate(chunks), n_bytes
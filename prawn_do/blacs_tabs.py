@@ -15,7 +15,7 @@ class PrawnDOTab(DeviceTab):
         self.com_port = device.properties['com_port']
 
         self.supports_remote_value_check(False)
-        self.supports_smart_programming(False)
+        self.supports_smart_programming(True)
 
     def initialise_workers(self):
         self.create_worker(
@@ -26,3 +26,30 @@ class PrawnDOTab(DeviceTab):
             },
         )
         self.primary_worker = "main_worker"
+
+class PrawnDOGroupTab(DeviceTab):
+    def initialise_GUI(self):
+        device = self.settings['connection_table'].find_by_name(self.device_name)
+
+        self.com_ports = device.properties['com_ports']
+
+        do_prop = {}
+        for i in range(0, 16 * len(self.com_ports)):
+            do_prop['0x{:02x}'.format(i)] = {}
+        self.create_digital_outputs(do_prop)
+
+        _, _, do_widgets = self.auto_create_widgets()
+        self.auto_place_widgets(do_widgets)
+
+        self.supports_remote_value_check(False)
+        self.supports_smart_programming(True)
+
+    def initialise_workers(self):
+        self.create_worker(
+            "main_worker",
+            "user_devices.prawn_do.blacs_workers.PrawnDOGroupWorker",
+            {
+                'com_ports': self.com_ports,
+            },
+        )
+        self.primary_worker = "main_worker"
@@ -2,21 +2,34 @@ from blacs.tab_base_classes import Worker
 import labscript_utils.h5_lock, h5py
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from user_devices.prawn_do import prawn_do_protocol
+from user_devices import pico_protocol, pico_upload
+
 class PrawnDOInterface(object):
     def __init__(self, com_port):
         global serial; import serial
 
         self.timeout = 0.1
+        self.dump_timeout = 5 # Dumps of long tables take a while to read back
         self.conn = serial.Serial(com_port, 10000000, timeout=self.timeout)
+        # Rows uploaded since the last clear, for verify and overwrite, or None if not kept
+        self.uploaded = []
 
         self.clear()
         if not self.clear():
             raise RuntimeError('Unable to communicate with PrawnDO Pico')
 
+        self.capabilities = pico_protocol.get_capabilities(self.conn)
+        # The uploaded rows are only needed to verify or overwrite the table
+        self.keep_uploaded = bool(self.capabilities & {'crc', 'ovr'})
+
     def clear(self):
         '''Sends 'cls' command, which clears the currently stored run.
         Returns response, throws serial exception on disconnect.'''
         self.conn.write(b'cls\n')
+        self.uploaded = []
         # Note that read_until should read until the prompt, not newline
         return self.conn.read_until(b'> ')
 
@@ -38,53 +51,169 @@ class PrawnDOInterface(object):
         self.conn.write(b'dmp\n')
         return self.conn.read_until(b'> ')
 
+    def set_output(self, bit_set):
+        '''Sends 'set' command, which immediately outputs bit_set and leaves it
+        as the only row of the stored run, as abort, clear, add and run would,
+        but in a single round trip.
+        Returns response, throws RuntimeError if the Pico rejects it or does not reply.'''
+        self.conn.write('set:0x{:04x}\n'.format(int(bit_set)).encode())
+        resp = self.conn.read_until(b'> ')
+        if pico_protocol.is_error(resp) or not resp.endswith(b'> '):
+            raise RuntimeError('PrawnDO Pico did not set its output: {}'
+                               .format(resp.decode(errors='replace').strip()))
+        self.uploaded = [np.array([bit_set], dtype=prawn_do_protocol.table_dtype)]
+        return resp
+
     def add(self, bit_set):
         '''Sends 'add' command for a single set of output bits
         Returns response, throws serial exception on disconnect.'''
-        self.conn.write('add\n'.encode())
-        self.conn.write('0x{:04x}\n'.format(bit_set).encode()) # Send bits as hex string
-        self.conn.write('end\n'.encode())
-        return self.conn.read_until(b'> ')
+        return self.add_batch([bit_set])
 
     def add_batch(self, bit_sets):
-        '''Sends 'add' commands for each bit_set in bit_sets list. Returns response.'''
-        self.conn.write('add\n'.encode())
-        for bit_set in bit_sets:
-            # Send each set of bits as hex string on its own line
-            self.conn.write('0x{:04x}\n'.format(bit_set).encode())
-        self.conn.write('end\n'.encode())
+        '''Sends 'add' command with each bit_set in bit_sets (a list, uint16 array
+        or h5py dataset) as a hex string on its own line. The lines are encoded
+        a chunk at a time with a lookup table, overlapping with the writes
+        (see pico_upload). Returns response.'''
+        if not hasattr(bit_sets, 'dtype'):
+            bit_sets = np.asarray(bit_sets, dtype=prawn_do_protocol.table_dtype)
+        rows, _ = pico_upload.write_chunked(
+            self.conn, bit_sets, lambda chunk: prawn_do_protocol.encode_text(chunk).tobytes(),
+            b'add\n', prawn_do_protocol.binary_terminator, self._keep_uploaded())
+        self._add_uploaded(rows, prawn_do_protocol.table_dtype)
         return self.conn.read_until(b'> ')
 
+    def add_rle(self, rle):
+        '''Sends 'addr' command with a run length encoded table
+        (prawn_do_protocol.rle_dtype entries, as an array or h5py dataset)
+        packed as binary records, in chunks as for add_batch.
+        Returns response, throws RuntimeError if the Pico rejects it.'''
+        rows, _ = pico_upload.write_chunked(
+            self.conn, rle, lambda chunk: chunk.astype(prawn_do_protocol.rle_dtype).tobytes(),
+            prawn_do_protocol.rle_header(len(rle)), prawn_do_protocol.binary_terminator,
+            self._keep_uploaded())
+        resp = self.conn.read_until(b'> ')
+        if pico_protocol.is_error(resp):
+            raise RuntimeError('PrawnDO Pico rejected run length encoded upload: {}'
+                               .format(resp.decode(errors='replace').strip()))
+        self._add_uploaded(rows, prawn_do_protocol.rle_dtype)
+        return resp
+
+    def overwrite(self, table, ranges):
+        '''Sends an 'ovr' command for each (start, stop) range in ranges, replacing those
+        entries of the stored table with the same entries of table,
+        which must have the same length and dtype as the stored table.
+        All commands are sent in a single write.
+        Returns response, throws RuntimeError if the Pico rejects any of them.'''
+        size = table.dtype.itemsize
+        payload = b''.join(prawn_do_protocol.overwrite_header(start, stop - start, size)
+                           + table[start:stop].tobytes() + prawn_do_protocol.binary_terminator
+                           for start, stop in ranges)
+        self.conn.write(payload)
+        resp = b''.join(self.conn.read_until(b'> ') for _ in ranges)
+        if pico_protocol.is_error(resp) or resp.count(b'> ') < len(ranges):
+            raise RuntimeError('PrawnDO Pico rejected table overwrite: {}'
+                               .format(resp.decode(errors='replace').strip()))
+        if self.uploaded:
+            stored = np.concatenate(self.uploaded)
+            for start, stop in ranges:
+                stored[start:stop] = table[start:stop]
+            self.uploaded = [stored]
+        return resp
+
+    def supports_payload(self, protocol):
+        '''Whether a payload precomputed with the given protocol can be sent to this Pico.'''
+        if protocol not in prawn_do_protocol.payload_protocols:
+            return False
+        capability = prawn_do_protocol.payload_protocols[protocol]
+        return capability is None or capability in self.capabilities
+
+    def add_payload(self, payload, protocol):
+        '''Sends a uint8 payload made by prawn_do_protocol.encode_payload
+        (an array or h5py dataset) as is, in chunks as for add_batch.
+        Returns response.'''
+        payload, _ = pico_upload.write_chunked(self.conn, payload, lambda chunk: chunk.tobytes(),
+                                               keep_rows=self._keep_uploaded())
+        if payload is not None:
+            payload = prawn_do_protocol.payload_rows(payload, protocol)
+        self._add_uploaded(payload, prawn_do_protocol.table_dtype)
+        return self.conn.read_until(b'> ')
+
+    def _keep_uploaded(self):
+        '''Whether the rows of the next upload are needed, so should be kept.'''
+        return self.keep_uploaded and self.uploaded is not None
+
+    def _add_uploaded(self, rows, dtype):
+        '''Adds the rows of an upload to self.uploaded, which becomes None if they were not kept.'''
+        if rows is None or self.uploaded is None:
+            self.uploaded = None
+        else:
+            self.uploaded.append(rows.astype(dtype))
+
+    def verify(self):
+        '''Sends 'crc' command, and compares the checksum of the table on the Pico
+        with that of the rows uploaded since the last clear.
+        Only if they differ is the table dumped, to find the rows which differ.
+        Throws RuntimeError if the table does not match the upload.'''
+        if self.uploaded is None:
+            raise RuntimeError('PrawnDO Pico upload was not kept, cannot verify it')
+        if self.uploaded:
+            expected = np.concatenate(self.uploaded)
+        else:
+            expected = np.empty(0, dtype=prawn_do_protocol.table_dtype)
+
+        value = pico_protocol.query(self.conn, b'crc')
+        if value is None:
+            raise RuntimeError('PrawnDO Pico did not report a checksum')
+        if int(value, 16) == prawn_do_protocol.checksum(expected):
+            return
+
+        self.conn.timeout = self.dump_timeout
+        try:
+            actual = prawn_do_protocol.parse_dump(self.dump())
+        finally:
+            self.conn.timeout = self.timeout
+        rows = prawn_do_protocol.diff_rows(expected, actual)
+        if not len(rows):
+            raise RuntimeError('PrawnDO Pico table checksum does not match the upload, '
+                               'but its dump does')
+        raise RuntimeError('PrawnDO Pico table does not match the upload: '
+                           '{:d} of {:d} rows differ, the first is row {:d}'
+                           .format(len(rows), len(expected), rows[0]))
+
     def close(self):
         self.conn.close()
 
 class PrawnDOWorker(Worker):
     def init(self):
         self.intf = PrawnDOInterface(self.com_port)
+        # Table stored on the Pico by the last shot, for delta uploads, or None if unknown
+        self.last_table = None
+        # Whether the Pico is known to be running a manual mode table
+        self.manual = False
 
     def program_manual(self, front_panel_values):
-        self.intf.abort() # stop current run, if it is happening
-        self.intf.clear() # clear current Pi Pico buffer
+        self.last_table = None
 
         values = np.zeros(1, dtype=np.uint16) # Make 16 bit unsigned integer
         for conn, value in front_panel_values.items():
             # "Or" each bit from the front panel into the integer
             values[0] |= value << (int(conn, 16))
         # Send to the Pi Pico
-        self.intf.add(values[0])
-
-        self.intf.run()
+        manual = self.manual
+        self.manual = False # Unknown until programming succeeds
+        _program_output(self.intf, values[0], manual)
+        self.manual = True
 
     def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
+        self.manual = False
         self.intf.abort() # stop current run, if it is happening
-        self.intf.clear() # clear current Pi Pico buffer
 
+        last_table = self.last_table
+        self.last_table = None # Unknown until the upload succeeds
+        # Upload while the file is open, so the table is read as it is sent
         with h5py.File(h5file, 'r') as hdf5_file:
-            group = hdf5_file['devices'][device_name]
-            do_table = group['do_data']
-            # The data "table" contains only a single column of integers, so just convert to list
-            # Need to append an initial zero, since first output occurs immediately (before trigger)
-            self.intf.add_batch([0] + list(do_table))
+            self.last_table = _upload_table(self.intf, hdf5_file['devices'][device_name],
+                                            last_table, fresh)
 
         self.intf.run()
 
@@ -98,8 +227,152 @@ class PrawnDOWorker(Worker):
         return True
 
     def abort_transition_to_buffered(self):
+        self.last_table = None
         self.intf.abort()
         return True
 
     def shutdown(self):
         self.intf.close()
+
+class PrawnDOGroupWorker(Worker):
+    def init(self):
+        # One thread per board, so uploads to all boards proceed concurrently
+        self.pool = ThreadPoolExecutor(max_workers=len(self.com_ports))
+        futures = [self.pool.submit(PrawnDOInterface, com_port) for com_port in self.com_ports]
+        wait(futures)
+        failed = [future for future in futures if future.exception() is not None]
+        if failed:
+            # Close the boards which did open, so their ports are free for the next attempt
+            for future in futures:
+                if future.exception() is None:
+                    future.result().close()
+            self.pool.shutdown()
+            raise failed[0].exception()
+        self.intfs = [future.result() for future in futures]
+        # Tables stored on each Pico by the last shot, for delta uploads, or None if unknown
+        self.last_tables = [None] * len(self.intfs)
+        # Whether the Picos are known to be running a manual mode table
+        self.manual = False
+
+    def _map(self, function, *iterables):
+        '''Calls function with the arguments for each board concurrently.
+        Returns the results in board order, once every call has finished,
+        raising the first exception if any failed.'''
+        futures = [self.pool.submit(function, *args) for args in zip(*iterables)]
+        wait(futures)
+        return [future.result() for future in futures]
+
+    def program_manual(self, front_panel_values):
+        self.last_tables = [None] * len(self.intfs)
+
+        values = np.zeros(len(self.intfs), dtype=np.uint16) # 16 bits for each board
+        for conn, value in front_panel_values.items():
+            line = int(conn, 16)
+            values[line // 16] |= value << (line % 16)
+
+        manual = self.manual
+        self.manual = False # Unknown until programming succeeds
+        self._map(_program_output, self.intfs, values, [manual] * len(self.intfs))
+        self.manual = True
+
+    def transition_to_buffered(self, device_name, h5file, initial_values, fresh):
+        self.manual = False
+        self._map(PrawnDOInterface.abort, self.intfs)
+
+        last_tables = self.last_tables
+        self.last_tables = [None] * len(self.intfs) # Unknown until the uploads succeed
+        with h5py.File(h5file, 'r') as hdf5_file:
+            group = hdf5_file['devices'][device_name]
+            groups = [group['board {:d}'.format(board)] for board in range(len(self.intfs))]
+            def upload(intf, group, last_table):
+                return _upload_table(intf, group, last_table, fresh)
+            self.last_tables = self._map(upload, self.intfs, groups, last_tables)
+
+        self._map(PrawnDOInterface.run, self.intfs)
+
+        return {}
+
+    def transition_to_manual(self):
+        return True
+
+    def abort_buffered(self):
+        self._map(PrawnDOInterface.abort, self.intfs)
+        return True
+
+    def abort_transition_to_buffered(self):
+        self.last_tables = [None] * len(self.intfs)
+        self._map(PrawnDOInterface.abort, self.intfs)
+        return True
+
+    def shutdown(self):
+        self._map(PrawnDOInterface.close, self.intfs)
+        self.pool.shutdown()
+
+def _program_output(intf, bit_set, manual):
+    '''Makes the PrawnDO output bit_set until the next shot. If manual (the Pico is running
+    a manual mode table) and the firmware supports it, this is a single 'set' command,
+    otherwise (or if that fails) the run is aborted and replaced by a one row table.'''
+    if manual and 'set' in intf.capabilities:
+        try:
+            intf.set_output(bit_set)
+            return
+        except RuntimeError:
+            pass # Fall back to the full cycle, which leaves the Pico in a known state
+    intf.abort() # stop current run, if it is happening
+    intf.clear() # clear current Pi Pico buffer
+    intf.add(bit_set)
+    intf.run()
+
+def _read_table(intf, group):
+    '''Finds the table for one PrawnDO in its group of the shot file,
+    in the most compact encoding intf supports.
+    Returns (table, payload, protocol), with payload and protocol None
+    unless the table has a precomputed payload intf can take, in which case table is None.
+    The table or payload is only read from the file when sliced, so it can be uploaded
+    in chunks while the file is open.'''
+    if 'do_rle' in group and 'rle' in intf.capabilities:
+        # Prepend the initial zero, as for the uncompressed table
+        table = pico_upload.Concatenated([np.array([(0, 1)], dtype=prawn_do_protocol.rle_dtype),
+                                          group['do_rle']])
+        return table, None, None
+    elif 'payload' in group and intf.supports_payload(group['payload'].attrs['protocol']):
+        # Precomputed at compile time, including the initial zero
+        return None, group['payload'], group['payload'].attrs['protocol']
+    else:
+        # Need to prepend an initial zero, since first output occurs immediately (before trigger)
+        table = pico_upload.Concatenated([np.zeros(1, dtype=prawn_do_protocol.table_dtype),
+                                          group['do_data']])
+        return table, None, None
+
+def _upload_table(intf, group, last_table, fresh):
+    '''Uploads the table found by _read_table in group, streaming it from the file in chunks.
+    If last_table is the table the Pico holds, has the same length and encoding and fresh is False,
+    only the entries which changed are resent. The upload is verified if the firmware supports it.
+    Returns the table now held by the Pico.'''
+    table, payload, protocol = _read_table(intf, group)
+    if not fresh and 'ovr' in intf.capabilities and last_table is not None:
+        # The whole table is needed to find the entries which changed since the last shot
+        if payload is not None:
+            table = prawn_do_protocol.payload_rows(payload[()], protocol)
+            payload = None
+        else:
+            table = table[:]
+        if last_table.dtype == table.dtype and len(last_table) == len(table):
+            ranges = prawn_do_protocol.changed_ranges(last_table, table)
+            if len(ranges):
+                intf.overwrite(table, ranges)
+            if 'crc' in intf.capabilities:
+                intf.verify()
+            return table
+
+    intf.clear() # clear current Pi Pico buffer
+    if payload is not None:
+        intf.add_payload(payload, protocol)
+    elif table.dtype == prawn_do_protocol.rle_dtype:
+        intf.add_rle(table)
+    else:
+        intf.add_batch(table)
+    if 'crc' in intf.capabilities:
+        intf.verify()
+    # The rows read during the upload, which is the only one since the clear, if kept
+    return intf.uploaded[-1] if intf.uploaded else None
@@ -1,7 +1,11 @@
-from labscript import IntermediateDevice, DigitalOut, bitfield, set_passed_properties
+from labscript import IntermediateDevice, DigitalOut, LabscriptError, set_passed_properties
+
+import re
 
 import numpy as np
 
+from user_devices.prawn_do import prawn_do_protocol
+
 class PrawnDO(IntermediateDevice):
     allowed_children = [DigitalOut]
 
@@ -14,19 +18,127 @@ class PrawnDO(IntermediateDevice):
         }
     )
 
-    def __init__(self, name, parent_device, com_port, **kwargs):
+    def __init__(self, name, parent_device, com_port, precompute_payload=False,
+                 change_only=False, **kwargs):
+        '''
+        Args:
+        precompute_payload: If True, also store the exact bytes of the upload,
+        	which the worker sends in a single write if the firmware supports that encoding.
+        change_only: If True, drop instructions which do not change the state of their output
+        	before the clock is generated, so the PrawnDO only requests clock ticks
+        	where its outputs actually change.
+        '''
         IntermediateDevice.__init__(self, name, parent_device, **kwargs)
         self.BLACS_connection = 'PrawnDO: {}'.format(name)
+        self.precompute_payload = precompute_payload
+        self.change_only = change_only
+
+    def get_all_outputs(self):
+        # Called by the pseudoclock to collect change times, so this is the last chance
+        # to drop redundant instructions before the clock ticks are decided
+        outputs = IntermediateDevice.get_all_outputs(self)
+        if self.change_only:
+            n_removed = sum(_drop_repeated_instructions(output) for output in outputs)
+            if n_removed:
+                print('{}: change only mode removed {:d} instructions'.format(self.name, n_removed))
+        return outputs
 
     def generate_code(self, hdf5_file):
         IntermediateDevice.generate_code(self, hdf5_file)
 
-        bits = [0] * 16 # Start with a list of 16 zeros
+        do_table = _pack_lines(self.child_devices, np.uint16)
+
+        group = hdf5_file['devices'].require_group(self.name)
+        self._save_table(group, do_table)
+
+    def _save_table(self, group, do_table):
+        '''Saves the 16 bit table of one PrawnDO, and the other encodings of it, to group.'''
+        group.create_dataset('do_data', data=do_table)
+        # Run length encoded copy, uploaded instead by firmware supporting it
+        group.create_dataset('do_rle', data=prawn_do_protocol.run_length_encode(do_table))
+        if self.precompute_payload:
+            # The worker uploads an initial zero, since first output occurs immediately
+            protocol, payload = prawn_do_protocol.encode_payload(np.append(0, do_table))
+            dataset = group.create_dataset('payload', data=payload)
+            dataset.attrs['protocol'] = protocol
+
+class PrawnDOGroup(PrawnDO):
+    '''Several PrawnDOs on the same clock line, driven as one device with 16 lines per board.
+    Line 0xn is output n % 16 of board n // 16, where boards are numbered
+    in the order of com_ports. Up to 4 boards (64 lines) are supported.'''
+
+    @set_passed_properties(
+        property_names={
+            'connection_table_properties': [
+                'name',
+                'com_ports',
+            ]
+        }
+    )
+
+    def __init__(self, name, parent_device, com_ports, precompute_payload=False,
+                 change_only=False, **kwargs):
+        '''
+        Args:
+        com_ports: List of the serial ports of the boards, in order.
+        precompute_payload, change_only: As for PrawnDO, applied to every board.
+        '''
+        if not 1 <= len(com_ports) <= 4:
+            raise LabscriptError('{} must have between 1 and 4 boards'.format(name))
+        IntermediateDevice.__init__(self, name, parent_device, **kwargs)
+        self.BLACS_connection = 'PrawnDOGroup: {}'.format(name)
+        self.com_ports = list(com_ports)
+        self.precompute_payload = precompute_payload
+        self.change_only = change_only
+
+    def add_device(self, device):
+        # The front panel names the lines '0x00' to '0x3f', which connections must match
+        if not re.fullmatch('0x[0-9a-f]{2}', device.connection):
+            raise LabscriptError('{} is connected to {} of {}, but PrawnDOGroup lines must be '
+                                 'two lowercase hex digits, e.g. \'0x05\''
+                                 .format(device.name, device.connection, self.name))
+        IntermediateDevice.add_device(self, device)
+
+    def generate_code(self, hdf5_file):
+        IntermediateDevice.generate_code(self, hdf5_file)
+
+        n_boards = len(self.com_ports)
         for line in self.child_devices:
-            # Replace each zero with the list for each output
-            bits[int(line.connection, 16)] = line.raw_output
-        # Merge list of lists into an array with a single 16 bit integer column
-        do_table = np.array(bitfield(bits, dtype=np.uint16))
+            if int(line.connection, 16) >= 16 * n_boards:
+                raise LabscriptError('{} has {:d} boards, so has no line {}'
+                                     .format(self.name, n_boards, line.connection))
+        dtype = np.dtype('<u4') if n_boards <= 2 else np.dtype('<u8')
+        do_table = _pack_lines(self.child_devices, dtype)
 
         group = hdf5_file['devices'].require_group(self.name)
         group.create_dataset('do_data', data=do_table)
+        # Split into one 16 bit table per board, stored as for a single PrawnDO
+        words = do_table.view('<u2').reshape(len(do_table), dtype.itemsize // 2)
+        for board in range(n_boards):
+            self._save_table(group.create_group('board {:d}'.format(board)),
+                             np.ascontiguousarray(words[:, board]))
+
+def _pack_lines(lines, dtype):
+    '''Shifts the raw output of each line into a single integer column of dtype.'''
+    dtype = np.dtype(dtype)
+    if lines:
+        do_table = np.zeros(len(lines[0].raw_output), dtype=dtype)
+    else:
+        do_table = np.zeros(0, dtype=dtype)
+    for line in lines:
+        do_table |= line.raw_output.astype(dtype) << dtype.type(int(line.connection, 16))
+    return do_table
+
+def _drop_repeated_instructions(output):
+    '''Removes instructions of output which set the value it already has.
+    Returns the number of instructions removed.'''
+    n_removed = 0
+    previous = None
+    for t in sorted(output.instructions):
+        value = output.instructions[t]
+        if previous is not None and not isinstance(value, dict) and value == previous:
+            del output.instructions[t]
+            n_removed += 1
+        else:
+            previous = value
+    return n_removed
@@ -0,0 +1,136 @@
+'''Encodings of the PrawnDO output table used for upload over serial.
+
+These only depend on numpy, so they can be shared between labscript (compile time)
+and BLACS (upload time).'''
+import zlib
+
+import numpy as np
+
+# Each row of the table is the state of the 16 outputs, bit n driving output 0xn
+table_dtype = np.dtype('<u2')
+
+# Run length encoded table entry: the state of the outputs, held for repeat clock ticks
+rle_dtype = np.dtype([('bits', '<u2'), ('repeat', '<u4')])
+
+binary_terminator = b'end\n'
+
+# Payloads precomputed at compile time are stored with a 'protocol' attribute naming
+# their encoding, mapped here to the firmware capability needed to send them (None if any).
+# Bump the version whenever an encoding changes, so old shot files fall back to do_data.
+payload_protocols = {'add/1': None}
+
+_hex_digits = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+_hex_lines = None # Lookup table of the '0xhhhh\n' line for every 16 bit row, built on first use
+
+def _line_table():
+    global _hex_lines
+    if _hex_lines is None:
+        rows = np.arange(2**16, dtype=table_dtype)
+        lines = np.empty((len(rows), 7), dtype=np.uint8)
+        lines[:, 0] = ord('0')
+        lines[:, 1] = ord('x')
+        for digit in range(4):
+            lines[:, 2 + digit] = _hex_digits[(rows >> (12 - 4 * digit)) & 0xf]
+        lines[:, 6] = ord('\n')
+        _hex_lines = lines
+    return _hex_lines
+
+def encode_text(bit_sets):
+    '''Encodes rows as the '0xhhhh' lines of an 'add' upload, returned as a uint8 array.
+    Each row indexes a 65536 entry lookup table of lines, so there is no per-row Python work.'''
+    bit_sets = np.asarray(bit_sets, dtype=table_dtype)
+    return _line_table()[bit_sets].ravel()
+
+def encode_payload(bit_sets):
+    '''Encodes rows as the exact bytes of an 'add' upload, so it can be sent in a single write.
+    Returns (protocol, payload), with the payload as a uint8 array.'''
+    payload = np.concatenate([np.frombuffer(b'add\n', dtype=np.uint8),
+                              encode_text(bit_sets),
+                              np.frombuffer(b'end\n', dtype=np.uint8)])
+    return 'add/1', payload
+
+def payload_rows(payload, protocol):
+    '''Returns the rows held in a payload made by encode_payload.'''
+    lines = np.asarray(payload, dtype=np.uint8)[4:-4].reshape(-1, 7)
+    # Value of each hex digit character
+    values = np.zeros(256, dtype=table_dtype)
+    values[_hex_digits] = np.arange(16)
+    bit_sets = np.zeros(len(lines), dtype=table_dtype)
+    for digit in range(4):
+        bit_sets = (bit_sets << 4) | values[lines[:, 2 + digit]]
+    return bit_sets
+
+def run_length_encode(bit_sets):
+    '''Returns rows as a run length encoded table, with one rle_dtype entry
+    per run of identical rows.'''
+    bit_sets = np.asarray(bit_sets, dtype=table_dtype)
+    starts = np.flatnonzero(np.diff(bit_sets)) + 1
+    starts = np.concatenate([[0], starts]) if len(bit_sets) else starts
+    rle = np.empty(len(starts), dtype=rle_dtype)
+    rle['bits'] = bit_sets[starts]
+    rle['repeat'] = np.diff(np.append(starts, len(bit_sets)))
+    return rle
+
+def run_length_decode(rle):
+    '''Returns the rows of a run length encoded table.'''
+    return np.repeat(rle['bits'], rle['repeat'])
+
+def rle_header(count):
+    '''Header line for an 'addr' upload of count rle_dtype entries.
+    The firmware reads exactly count * entry size bytes after the newline,
+    then expects binary_terminator.'''
+    return 'addr:{:d},{:d}\n'.format(count, rle_dtype.itemsize).encode()
+
+def encode_rle(rle):
+    '''Encodes a run length encoded table as the bytes of an 'addr' upload.'''
+    return (rle_header(len(rle)) + np.asarray(rle, dtype=rle_dtype).tobytes()
+            + binary_terminator)
+
+def overwrite_header(start, count, size):
+    '''Header line for an 'ovr' upload, replacing count entries of size bytes
+    from index start of the stored table (rows, or entries of a run length encoded table).
+    The firmware reads exactly count * size bytes after the newline,
+    then expects binary_terminator.'''
+    return 'ovr:{:d},{:d},{:d}\n'.format(start, count, size).encode()
+
+def changed_ranges(old, new, merge_gap=16):
+    '''Returns the (start, stop) index ranges of entries which differ between
+    two tables of the same length and dtype, as an array of shape (n, 2).
+    Ranges separated by fewer than merge_gap unchanged entries are merged,
+    since resending those is cheaper than another command.'''
+    changed = np.concatenate([[False], old != new, [False]])
+    edges = np.flatnonzero(changed[1:] != changed[:-1])
+    starts, stops = edges[::2], edges[1::2]
+    if len(starts):
+        separate = starts[1:] - stops[:-1] >= merge_gap
+        starts = starts[np.concatenate([[True], separate])]
+        stops = stops[np.concatenate([separate, [True]])]
+    return np.stack([starts, stops], axis=1)
+
+def checksum(table):
+    '''CRC32 of the table, as reported by the firmware's 'crc' command,
+    which is computed over the rows as little-endian 16 bit integers,
+    or over the packed entries of a run length encoded table.'''
+    table = np.asarray(table)
+    if table.dtype != rle_dtype:
+        table = table.astype(table_dtype)
+    return zlib.crc32(table.tobytes()) & 0xffffffff
+
+def parse_dump(resp):
+    '''Parses the reply to 'dmp', one hex row per line, into an array of rows.
+    Lines '0xhhhh,<repeat>' of a run length encoded table are parsed into rle_dtype entries.'''
+    rows = []
+    for line in resp.decode(errors='replace').splitlines():
+        line = line.strip()
+        if line.startswith('0x'):
+            rows.append(tuple(int(value, 0) for value in line.split(',')))
+    if rows and len(rows[0]) == 2:
+        return np.array(rows, dtype=rle_dtype)
+    return np.array([row[0] for row in rows], dtype=table_dtype)
+
+def diff_rows(expected, actual):
+    '''Returns the indices of rows which differ between two tables,
+    including any rows present in only one of them.'''
+    n = min(len(expected), len(actual))
+    return np.concatenate([np.flatnonzero(expected[:n] != actual[:n]),
+                           np.arange(n, max(len(expected), len(actual)))])
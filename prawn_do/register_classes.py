@@ -3,5 +3,11 @@ from labscript_devices import register_classes
 register_classes(
     'PrawnDO',
     BLACS_tab='user_devices.prawn_do.blacs_tabs.PrawnDOTab',
-    runviewer_parser=None,
+    runviewer_parser='user_devices.prawn_do.runviewer_parsers.PrawnDOParser',
+)
+
+register_classes(
+    'PrawnDOGroup',
+    BLACS_tab='user_devices.prawn_do.blacs_tabs.PrawnDOGroupTab',
+    runviewer_parser='user_devices.prawn_do.runviewer_parsers.PrawnDOParser',
 )
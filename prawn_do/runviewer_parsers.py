@@ -0,0 +1,50 @@
+import labscript_utils.h5_lock, h5py
+import numpy as np
+
+class PrawnDOParser(object):
+    def __init__(self, path, device):
+        self.path = path
+        self.name = device.name
+        self.device = device
+
+    def get_traces(self, add_trace, clock=None):
+        if clock is None:
+            # The PrawnDO advances on each rising edge of its clock line, so no clock, no traces
+            return {}
+
+        times, clock_value = clock[0], clock[1]
+        clock_indices = np.flatnonzero(np.diff(clock_value) == 1) + 1
+        # A clock which starts high has a rising edge at the start too
+        if clock_value[0] == 1:
+            clock_indices = np.insert(clock_indices, 0, 0)
+        clock_ticks = times[clock_indices]
+
+        with h5py.File(self.path, 'r') as f:
+            do_table = f['devices'][self.name]['do_data'][()]
+
+        n_ticks = min(len(clock_ticks), len(do_table))
+        clock_ticks = clock_ticks[:n_ticks]
+        do_table = do_table[:n_ticks]
+        # The outputs are low until the first tick
+        if n_ticks == 0 or clock_ticks[0] > times[0]:
+            clock_ticks = np.insert(clock_ticks, 0, times[0])
+            do_table = np.insert(do_table, 0, 0)
+
+        # Unpack all outputs at once, column n holding output 0xn.
+        # The table is 16 bit for a PrawnDO, or 32 or 64 bit for a PrawnDOGroup.
+        do_table = do_table.astype(do_table.dtype.newbyteorder('<'))
+        bits = np.unpackbits(do_table.view(np.uint8).reshape(-1, do_table.dtype.itemsize),
+                             axis=1, bitorder='little')
+        # Only keep the ticks where each output changes, plus the last one to end the trace
+        changes = np.diff(bits, axis=0) != 0
+
+        traces = {}
+        for channel_name, channel in self.device.child_list.items():
+            line = int(channel.parent_port, 16)
+            indices = np.concatenate([[0], np.flatnonzero(changes[:, line]) + 1,
+                                      [len(clock_ticks) - 1]])
+            trace = (clock_ticks[indices], bits[indices, line])
+            traces[channel_name] = trace
+            add_trace(channel_name, trace, self.name, channel.parent_port)
+
+        return traces
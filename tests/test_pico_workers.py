@@ -0,0 +1,119 @@
+'''Tests of the BLACS workers of the Pi Pico based devices against the stand-in firmware
+in pico_simulator.py, which needs a pseudo-terminal (Linux/macOS only): that table
+verification catches a corrupted table, that PrawnDO shots changing a few rows only resend
+those ('ovr'), and that front panel changes are single 'set' commands.'''
+import logging
+
+import pytest
+import numpy as np
+
+pytest.importorskip('termios') # pseudo-terminals
+pytest.importorskip('serial')
+h5py = pytest.importorskip('h5py')
+from user_devices.pico_simulator import AD9914PicoSimulator, PrawnDOSimulator
+from user_devices.AD9914_pico.blacs_workers import AD9914PicoWorker
+from user_devices.AD9914_pico import ad9914_protocol
+from user_devices.prawn_do.blacs_workers import PrawnDOWorker
+from user_devices.prawn_do import prawn_do_protocol
+
+@pytest.fixture
+def connect():
+    '''Returns a function starting a simulator with the given capabilities, and a worker
+    talking to it, which are both closed again after the test.'''
+    simulators, workers = [], []
+    def connect(simulator_class, worker_class, capabilities):
+        simulator = simulator_class(capabilities=capabilities)
+        simulators.append(simulator)
+        # Created outside of BLACS, which would otherwise start it in a process of its own
+        # with these attributes set
+        worker = worker_class.__new__(worker_class)
+        worker.com_port = simulator.port
+        worker.logger = logging.getLogger(worker_class.__name__)
+        worker.init()
+        workers.append(worker)
+        return simulator, worker
+    yield connect
+    for worker in workers:
+        worker.shutdown()
+    for simulator in simulators:
+        simulator.close()
+
+def write_shot(path, device_name, **datasets):
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('devices/' + device_name)
+        for name, data in datasets.items():
+            group.create_dataset(name, data=data)
+    return str(path)
+
+def test_prawn_do_crc(tmp_path, connect):
+    simulator, worker = connect(PrawnDOSimulator, PrawnDOWorker, ('crc',))
+    path = write_shot(tmp_path / 'shot.h5', 'pd', do_data=np.arange(1000, dtype=np.uint16))
+    worker.transition_to_buffered('pd', path, {}, True)
+    simulator.table[5] ^= 1
+    with pytest.raises(RuntimeError, match='the first is row 5'):
+        worker.intf.verify()
+
+def test_ad9914_crc(tmp_path, connect):
+    simulator, worker = connect(AD9914PicoSimulator, AD9914PicoWorker, ('bin', 'crc'))
+    commands = np.zeros(100, dtype=ad9914_protocol.dds_data_dtype)
+    commands['start freq'] = np.linspace(1e8, 2e8, len(commands))
+    commands['start amp'] = 0.5
+    path = write_shot(tmp_path / 'shot.h5', 'dds', dds_data=commands)
+    worker.transition_to_buffered('dds', path, {}, True)
+    record = np.frombuffer(simulator.table[17], dtype=ad9914_protocol.binary_record_dtype).copy()
+    record['start freq'] += 1
+    simulator.table[17] = record.tobytes()
+    with pytest.raises(RuntimeError, match='the first is row 17'):
+        worker.intf.verify()
+
+@pytest.mark.parametrize('capabilities', [('crc', 'ovr'), ('crc', 'rle', 'ovr')])
+def test_prawn_do_ovr(tmp_path, connect, capabilities):
+    simulator, worker = connect(PrawnDOSimulator, PrawnDOWorker, capabilities)
+    # Runs of 10 rows, each differing from the next
+    bit_sets = np.repeat(np.arange(1000) % 3, 10).astype(np.uint16)
+    for shot in range(3):
+        # Changing a whole run keeps the length of the run length encoded table
+        bit_sets[100 * shot:100 * shot + 10] ^= 0x4
+        path = write_shot(tmp_path / 'shot.h5', 'pd', do_data=bit_sets,
+                          do_rle=prawn_do_protocol.run_length_encode(bit_sets))
+        n_commands = simulator.commands_received
+        worker.transition_to_buffered('pd', path, {}, False)
+        table = np.array(simulator.table, dtype=(prawn_do_protocol.rle_dtype if simulator.rle
+                                                 else prawn_do_protocol.table_dtype))
+        if simulator.rle:
+            table = prawn_do_protocol.run_length_decode(table)
+        assert np.array_equal(table, np.append(0, bit_sets))
+        if shot:
+            # abt, a single ovr, crc and run
+            assert simulator.commands_received - n_commands == 4
+
+def test_prawn_do_set(connect):
+    simulator, worker = connect(PrawnDOSimulator, PrawnDOWorker, ('crc', 'set'))
+    worker.program_manual({'0x0': 1})
+    for value in [0, 1]:
+        n_commands = simulator.commands_received
+        worker.program_manual({'0x0': value, '0x3': 1})
+        assert simulator.commands_received - n_commands == 1
+        assert simulator.output == 0x8 | value
+    # Firmware rejecting 'set' falls back to the full cycle
+    simulator.capabilities.discard('set')
+    worker.program_manual({'0x1': 1})
+    assert simulator.output == 0x2
+
+def test_ad9914_set(connect):
+    simulator, worker = connect(AD9914PicoSimulator, AD9914PicoWorker, ('bin', 'set'))
+    worker.program_manual({'output': {'freq': 1e8, 'amp': 0.5}})
+    n_commands = simulator.commands_received
+    worker.program_manual({'output': {'freq': 2e8, 'amp': 0.25}})
+    assert simulator.commands_received - n_commands == 1
+    assert simulator.output == (2e8, 0.25)
+
+def test_ad9914_stream_keeps_no_records(tmp_path, connect):
+    simulator, worker = connect(AD9914PicoSimulator, AD9914PicoWorker, ('bin', 'crc', 'stream'))
+    commands = np.zeros(worker.intf.free() + 100, dtype=ad9914_protocol.dds_data_dtype)
+    commands['start amp'] = 0.5
+    path = write_shot(tmp_path / 'shot.h5', 'dds', dds_data=commands)
+    worker.transition_to_buffered('dds', path, {}, True)
+    assert worker.streamer is not None
+    # Played entries are freed, so a streamed table cannot be verified
+    assert worker.intf.uploaded is None
@@ -0,0 +1,50 @@
+'''Tests of the runviewer parsers, which only need h5py and the shot files written here.'''
+from types import SimpleNamespace
+
+import pytest
+import numpy as np
+
+h5py = pytest.importorskip('h5py')
+from user_devices.AD9914_pico import ad9914_protocol, runviewer_parsers
+from user_devices.AD9914_pico.runviewer_parsers import AD9914PicoParser
+
+def get_traces(path, commands):
+    with h5py.File(path, 'w') as f:
+        f.create_group('devices/dds').create_dataset('dds_data', data=commands)
+    device = SimpleNamespace(name='dds', child_list={'dds_freq': None, 'dds_amp': None})
+    traces = {}
+    def add_trace(name, trace, parent_device_name, connection):
+        traces[connection] = trace
+    AD9914PicoParser(str(path), device).get_traces(add_trace)
+    return traces
+
+def ramps(n, duration=1e-3):
+    '''n untriggered frequency ramps at a constant amplitude.'''
+    commands = np.zeros(n, dtype=ad9914_protocol.dds_data_dtype)
+    commands['sweep'] = True
+    commands['sweep time'] = duration
+    commands['start freq'] = np.arange(n) * 1e6
+    commands['stop freq'] = (np.arange(n) + 1) * 1e6
+    commands['start amp'] = commands['stop amp'] = 0.5
+    return commands
+
+@pytest.mark.parametrize('n', [1, 10, 1000, 10000])
+def test_points_grow_with_commands(tmp_path, n):
+    traces = get_traces(tmp_path / 'shot.h5', ramps(n))
+    # A point at the start of each command, and the ramps share a fixed budget
+    assert len(traces['freq'][0]) <= 2 * n + runviewer_parsers.ramp_points_budget
+    # The amplitude does not change, so gets no points within the ramps
+    assert len(traces['amp'][0]) == n
+    assert np.all(traces['amp'][1] == 0.5)
+
+def test_ramp_values(tmp_path):
+    commands = ramps(2)
+    commands['sweep time'] = [1e-3, 1e-6]
+    times, values = get_traces(tmp_path / 'shot.h5', commands)['freq']
+    assert np.all(np.diff(times) >= 0)
+    # The long ramp is drawn with the most points, the short one with just its ends
+    assert len(times) == runviewer_parsers.max_ramp_points + 3
+    n_long = runviewer_parsers.max_ramp_points + 1
+    assert np.allclose(values[:n_long], 1e6 * times[:n_long] / 1e-3)
+    assert np.allclose(times[n_long:], [1e-3, 1e-3 + 1e-6])
+    assert np.allclose(values[n_long:], [1e6, 2e6])